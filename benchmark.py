@@ -0,0 +1,272 @@
+#! /usr/bin/env python
+
+# Headless benchmarks of rsync under the flag profiles the GUI produces,
+# against reproducible synthetic trees. Results are written as JSON, and
+# can be compared against a stored baseline:
+#
+#   ./benchmark.py --scale 0.01 --output new.json --baseline old.json
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+
+from statistics import median
+from subprocess import Popen, DEVNULL, check_output
+from tempfile import mkdtemp
+
+import rsynccore as core
+
+def _profile(**choices):
+    # As built by the GUI: its "Full archival mode" flag set plus recursion,
+    # and the detection and deletion alternatives of the advanced options.
+    # Defaults such as --update are left off, or the update runs would skip
+    # the files _perturb touches.
+    profile = core.defaultprofile()
+    for flag in profile["flags"].values():
+        flag[1] = False
+    core.setarchive(profile, True)
+    profile["flags"]["recursive"][1] = True
+    profile["choices"].update(choices)
+    return core.buildcommand(profile)[1:]
+
+PROFILES = {"archive":       _profile(),
+            "checksum":      _profile(detection="--checksum"),
+            "size-only":     _profile(detection="--size-only"),
+            "delete-before": _profile(deletion="--delete-before"),
+            "delete-after":  _profile(deletion="--delete-after")}
+
+# Tree sizes at --scale 1
+_TINY_FILES = 1000000
+_TINY_PER_DIRECTORY = 1000
+_HUGE_FILES = 3
+_HUGE_SIZE = 1 << 30
+_SPARSE_FILES = 4
+_SPARSE_SIZE = 1 << 30
+_SPARSE_EXTENTS = 16
+_LINKED_FILES = 1000
+_LINKS_PER_FILE = 10
+_CHAINS = 50
+_CHAIN_DEPTH = 200
+
+def _scaled(n, scale):
+    return max(int(n * scale), 1)
+
+def _tiny(root, rng, scale):
+    for i in range(_scaled(_TINY_FILES, scale)):
+        directory = os.path.join(root, "{:04}".format(i // _TINY_PER_DIRECTORY))
+        if i % _TINY_PER_DIRECTORY == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, "{:06}".format(i)), "wb") as f:
+            f.write(rng.randbytes(rng.randrange(1, 512)))
+
+def _huge(root, rng, scale):
+    os.makedirs(root)
+    for i in range(_HUGE_FILES):
+        with open(os.path.join(root, "{}.bin".format(i)), "wb") as f:
+            remaining = _scaled(_HUGE_SIZE, scale)
+            while remaining:
+                chunk = min(remaining, 1 << 20)
+                f.write(rng.randbytes(chunk))
+                remaining -= chunk
+
+def _sparse(root, rng, scale):
+    os.makedirs(root)
+    size = _scaled(_SPARSE_SIZE, scale)
+    for i in range(_SPARSE_FILES):
+        with open(os.path.join(root, "{}.img".format(i)), "wb") as f:
+            f.truncate(size)
+            for _ in range(_SPARSE_EXTENTS):
+                f.seek(rng.randrange(size))
+                f.write(rng.randbytes(4096))
+
+def _hardlinks(root, rng, scale):
+    os.makedirs(root)
+    for i in range(_scaled(_LINKED_FILES, scale)):
+        original = os.path.join(root, "{:05}".format(i))
+        with open(original, "wb") as f:
+            f.write(rng.randbytes(rng.randrange(1, 8192)))
+        for j in range(_LINKS_PER_FILE):
+            os.link(original, "{}.{}".format(original, j))
+
+def _deep(root, rng, scale):
+    for i in range(_scaled(_CHAINS, scale)):
+        directory = os.path.join(root, str(i),
+                                 *["d"] * _scaled(_CHAIN_DEPTH, scale))
+        os.makedirs(directory)
+        with open(os.path.join(directory, "leaf"), "wb") as f:
+            f.write(rng.randbytes(64))
+
+TREES = {"tiny": _tiny, "huge": _huge, "sparse": _sparse,
+         "hardlinks": _hardlinks, "deep": _deep}
+
+def generate(workdir, scale, seed):
+    # Trees are reused across invocations with the same scale and seed
+    stamp = os.path.join(workdir, "trees.json")
+    key = {"scale": scale, "seed": seed}
+    try:
+        with open(stamp) as f:
+            if json.load(f) == key:
+                return
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(os.path.join(workdir, "trees"), ignore_errors=True)
+    for name, generator in TREES.items():
+        generator(os.path.join(workdir, "trees", name),
+                  random.Random("{}:{}".format(seed, name)), scale)
+    with open(stamp, "w") as f:
+        json.dump(key, f)
+
+def _perturb(destination, rng):
+    # Between the initial and update runs, damage the destination rather
+    # than touch the source, so the source stays identical across runs:
+    # ~1% of files get appended to, and as many extraneous files appear.
+    for directory, _, files in os.walk(destination):
+        for name in files:
+            if rng.random() < 0.01:
+                with open(os.path.join(directory, name), "ab") as f:
+                    f.write(b"\0")
+                with open(os.path.join(directory, name + ".extra"), "wb") as f:
+                    f.write(b"\0")
+
+def _measure(argv):
+    start = time.perf_counter()
+    process = Popen(argv, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {"wall": wall,
+            "cpu": usage.ru_utime + usage.ru_stime,
+            "maxrss": usage.ru_maxrss * 1024,
+            "returncode": process.returncode}
+
+def _syscalls(argv, workdir):
+    # A separate run: tracing skews everything else
+    output = os.path.join(workdir, "strace.txt")
+    _measure(["strace", "-f", "-c", "-o", output] + argv)
+    with open(output) as f:
+        for line in f:
+            # % time, seconds, usecs/call, calls, [errors,] "total"
+            fields = line.split()
+            if fields and fields[-1] == "total":
+                return int(fields[3])
+    return None
+
+def _prepare(workdir, argv, phase, loopback, rng):
+    # Returns the destination for a run, in the state the phase starts from
+    destination = os.path.join(workdir, "destination")
+    shutil.rmtree(destination, ignore_errors=True)
+    os.makedirs(destination)
+    if phase == "update":
+        _measure(argv + [destination])
+        _perturb(destination, rng)
+    return "localhost:" + destination if loopback else destination
+
+def run(workdir, profiles, trees, repeat, loopback, syscalls, seed):
+    results = []
+    for tree in trees:
+        source = os.path.join(workdir, "trees", tree) + "/"
+        for name in profiles:
+            argv = ["rsync"] + PROFILES[name] + [source]
+            for phase in ["initial", "update"]:
+                prepare = lambda: _prepare(workdir, argv, phase, loopback,
+                                           random.Random("{}:{}"
+                                                         .format(seed, tree)))
+                samples = [_measure(argv + [prepare()])
+                           for _ in range(repeat)]
+                result = {"tree": tree, "profile": name, "phase": phase,
+                          "returncode": max(sample["returncode"]
+                                            for sample in samples)}
+                for metric in ["wall", "cpu", "maxrss"]:
+                    result[metric] = median(sample[metric]
+                                            for sample in samples)
+                if syscalls:
+                    result["syscalls"] = _syscalls(argv + [prepare()],
+                                                   workdir)
+                results.append(result)
+                print("{tree:10} {profile:14} {phase:8} {wall:8.3f}s"
+                      " {cpu:8.3f}s CPU {maxrss:>12} B".format(**result),
+                      file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    # Yields (key, metric, old, new) for every metric that got worse by
+    # more than tolerance, relatively
+    old = {(result["tree"], result["profile"], result["phase"]): result
+           for result in baseline["results"]}
+    for result in results:
+        key = (result["tree"], result["profile"], result["phase"])
+        if key not in old:
+            continue
+        for metric in ["wall", "cpu", "maxrss", "syscalls"]:
+            before, after = old[key].get(metric), result.get(metric)
+            if before and after and after > before * (1 + tolerance):
+                yield key, metric, before, after
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark rsync flag"
+                                                 " profiles on synthetic"
+                                                 " trees.")
+    parser.add_argument("--scale", type=float, default=0.01,
+                        help="tree size, relative to the full benchmark")
+    parser.add_argument("--seed", default="tkrsync")
+    parser.add_argument("--workdir", help="where trees are generated and"
+                                          " kept (default: a temporary"
+                                          " directory, removed afterwards)")
+    parser.add_argument("--tree", action="append", choices=list(TREES))
+    parser.add_argument("--profile", action="append", choices=list(PROFILES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--loopback", action="store_true",
+                        help="sync to localhost over ssh too")
+    parser.add_argument("--syscalls", action="store_true",
+                        help="count system calls with strace")
+    parser.add_argument("--output", default="-")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or mkdtemp(prefix="tkrsync-benchmark-")
+    try:
+        generate(workdir, args.scale, args.seed)
+        results = run(workdir, args.profile or list(PROFILES),
+                      args.tree or list(TREES), args.repeat, False,
+                      args.syscalls, args.seed)
+        if args.loopback:
+            for result in run(workdir, args.profile or list(PROFILES),
+                              args.tree or list(TREES), args.repeat, True,
+                              args.syscalls, args.seed):
+                result["phase"] += "-loopback"
+                results.append(result)
+    finally:
+        # Trees run to gigabytes at full scale; only a given workdir is
+        # meant to keep them for next time
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"rsync": check_output(["rsync", "--version"],
+                                    text=True).splitlines()[0],
+              "scale": args.scale,
+              "seed": args.seed,
+              "results": results}
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = list(compare(results, baseline, args.tolerance))
+        for (tree, profile, phase), metric, before, after in regressions:
+            print("regression: {} {} {} {}: {:.4g} -> {:.4g}"
+                  .format(tree, profile, phase, metric, before, after),
+                  file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2560 @@
+#! /usr/bin/env python
+
+# The Tk-free core of tkrsync: its flag model and command building, and
+# running, parsing and scheduling rsync. Also a command line interface, to
+# run saved profiles headless (e.g. from cron):
+#
+#   ./tkrsync-cli run PROFILE...
+#
+# Keep it importable without tkinter, and cheap to import: modules only
+# some features need are imported where they're used.
+
+import os
+import re
+import sys
+import time
+import heapq
+import queue
+import atexit
+import codecs
+import shutil
+import signal
+import select
+import struct
+import json
+import hashlib
+import resource
+import argparse
+import threading
+
+from collections import OrderedDict, deque, Counter
+from subprocess import Popen, PIPE, DEVNULL, run, TimeoutExpired, \
+                       SubprocessError
+from getpass import getuser
+from itertools import count
+from stat import S_ISREG
+from shlex import quote, split
+from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
+
+# --- Flag model --- #
+
+# (description, flag, key) checkbuttons, by group, as laid out in the GUI's
+# advanced options.
+FLAGGROUPS = [("Attributes to preserve",
+               [("Permissions",                    "--perms",      "perms"),
+                ("Modification times",             "--times",      "mtimes"),
+                # -O, --omit-dir-times        omit directories from --times
+                # -J, --omit-link-times       omit symlinks from --times
+                ("Owning user",                    "--owner",      "owner"),
+                ("Owning group",                   "--group",      "group"),
+                ("Extended ACLs",                  "--acls",       "xacls"),
+                ("Extended attributes",            "--xattrs",     "xattrs")]),
+
+              # -L, --copy-links            transform symlink into referent file/dir
+              #     --copy-unsafe-links     only "unsafe" symlinks are transformed
+              #     --safe-links            ignore symlinks that point outside the tree
+              #     --munge-links           munge symlinks to make them safer
+              # -k, --copy-dirlinks         transform symlink to dir into referent dir
+              # -K, --keep-dirlinks         treat symlinked dir on receiver as dir
+              # -H, --hard-links            preserve hard links
+              #("Link handling",
+              # []),
+
+              #     --append                append data onto shorter files
+              #     --append-verify         --append w/old data in file checksum
+              #("Update mode",
+              # []),
+
+              # "Performance" is built separately below, as it's more than
+              # checkbuttons.
+
+              # Required for syncmode == "both"
+              # -u, --update                skip files that are newer on the receiver
+
+              # -c, --checksum              skip based on checksum, not mod-time & size
+              # -y, --fuzzy                 find similar file for basis if no dest file
+              # -I, --ignore-times          don't skip files that match size and time
+              #     --modify-window=NUM     compare mod-times with reduced accuracy
+              #     --size-only             skip files that match in size
+              #     --existing              skip creating new files on receiver
+              #     --ignore-existing       skip updating files that exist on receiver
+              #     --remove-source-files   sender removes synchronized files (non-dir)
+              #     --force                 force deletion of dirs even if not empty
+              # -m, --prune-empty-dirs      prune empty directory chains from file-list
+              #("Difference detection and resolution",
+              # []),
+
+              #     --numeric-ids           don't map uid/gid values by user/group name
+              #     --usermap=STRING        custom username mapping
+              #     --groupmap=STRING       custom groupname mapping
+              #     --chown=USER:GROUP      simple username/groupname mapping
+              #("Remote end file ownership",
+              # []),
+
+              #     --partial               keep partially transferred files
+              #     --partial-dir=DIR       put a partially transferred file into DIR
+              #     --append-verify         like --append, but with old data in file checksum
+
+              #     --timeout=SECONDS       set I/O timeout in seconds
+              #     --contimeout=SECONDS    set daemon connection timeout in seconds
+              #     --port=PORT             specify double-colon alternate port number
+              # -4, --ipv4                  prefer IPv4
+              # -6, --ipv6                  prefer IPv6
+              # Network options have widgets of their own (NETWORKFLAGS)
+
+              #     --link-dest=DIR         hardlink to files in DIR when unchanged
+              # -b, --backup                make backups (see --suffix & --backup-dir)
+              #     --backup-dir=DIR        make backups into hierarchy based in DIR
+              #     --suffix=SUFFIX         backup suffix (default ~ w/o --backup-dir)
+              #     --delay-updates         put all updated files into place at end
+              # --link-dest is managed by snapshots (see snapshotsteps())
+              ("Backup",
+               [("Put updated files into place at the end",
+                                                   "--delay-updates",
+                                                                "delayupdates")]),
+
+              #     --stats                 give some file-transfer stats
+              # -8, --8-bit-output          leave high-bit chars unescaped in output
+              # -h, --human-readable        output numbers in a human-readable format
+              # -i, --itemize-changes       output a change-summary for all updates
+              #     --log-file=FILE         log what we're doing to the specified FILE
+              #     --progress              show progress during transfer
+              # Progress is shown as indeterminate if this is unset.
+              ("Reporting",
+               [("Overall transfer progress",      "--info=progress2",
+                                                                   "progress"),
+                ("Transfer statistics (run metrics)", "--stats",   "stats")]),
+
+              # -x, --one-file-system       don't cross filesystem boundaries
+              #     --max-delete=NUM        don't delete more than NUM files
+              #     --max-size=SIZE         don't transfer any file larger than SIZE
+              #     --min-size=SIZE         don't transfer any file smaller than SIZE
+
+              # -C, --cvs-exclude           auto-ignore files in the same way CVS does
+              # -f, --filter=RULE           add a file-filtering RULE
+              #     --exclude=PATTERN       exclude files matching PATTERN
+              #     --exclude-from=FILE     read exclude patterns from FILE
+              #     --include=PATTERN       don't exclude files matching PATTERN
+              #     --include-from=FILE     read include patterns from FILE
+              #     --files-from=FILE       read list of source-file names from FILE
+
+              #     --bwlimit=RATE          limit socket I/O bandwidth
+              #("Throttling and filtering",
+              # []),
+
+              # Assorted:
+              #     --ignore-errors         delete even if there are I/O errors
+              # -n, --dry-run               perform a trial run with no changes made
+              #     --list-only             list the files instead of copying them
+              # -T, --temp-dir=DIR          create temporary files in directory DIR
+              #     --compare-dest=DIR      also compare received files relative to DIR
+              #     --copy-dest=DIR         ... and include copies of unchanged files
+
+              ("Additional file types to preserve",
+               [("Directories",                    "--dirs",       "directories"),
+                ("Symbolic links",                 "--links",      "slinks"),
+                ("Hard links",                     "--hard-links", "hlinks"),
+                ("Special files",                  "--specials",   "specials"),
+                ("Device files (super-user only)", "--devices",    "devices")])]
+
+# Flags with widgets of their own in the GUI
+PERFORMANCEFLAGS = [("Copy whole files (no delta-transfer)",
+                                             "--whole-file",  "wholefile"),
+                    ("Handle sparse files efficiently",
+                                             "--sparse",      "sparse"),
+                    ("Preallocate destination files",
+                                             "--preallocate", "preallocate"),
+                    ("Update destination files in place",
+                                             "--inplace",     "inplace")]
+NETWORKFLAGS = [("Keep partially transferred files, to resume them",
+                                "--partial-dir=.rsync-partial", "partial"),
+                ("Resume growing files by appending (checksum-verified)",
+                                "--append-verify",              "appendverify")]
+OTHERFLAGS = [("--update",    "update"),
+              ("--recursive", "recursive"),
+              ("--compress",  "compress")]
+FLAGS = dict([(key, flag) for _, group in FLAGGROUPS
+                          for _, flag, key in group]
+             + [(key, flag) for _, flag, key in PERFORMANCEFLAGS]
+             + [(key, flag) for _, flag, key in NETWORKFLAGS]
+             + [(key, flag) for flag, key in OTHERFLAGS])
+DEFAULTS = {"progress": True, "stats": True, "update": True}
+
+# Choices hold whole arguments (e.g. "--compress-level=6"), or "" for none
+CHOICES = ["deletion", "detection", "compresslevel", "skipcompress",
+           "blocksize", "timeout"]
+
+# As per rsync '-a' flag, minus recursion. Not exactly the semantics of the
+# original rsync, but sensible to someone who hasn't used it. Would they
+# care, they'd use rsync directly anyhow.
+ARCHIVEFLAGS = ["slinks", "perms", "mtimes",
+                "group", "owner", "devices", "specials",
+                # what users really should also care about, despite not
+                # being included in '-a' set
+                "xattrs", "xacls", "hlinks",
+                # We separate the notion of 'archiving' from recursing, but
+                # still copy directories themselves (not their contents).
+                "directories"]
+
+# --- Profiles: settings as plain data, for saving, queueing and the CLI --- #
+
+def defaultprofile():
+    return {"flags": {key: [flag, DEFAULTS.get(key, False)]
+                      for key, flag in FLAGS.items()},
+            "choices": dict.fromkeys(CHOICES, ""),
+            "localpath": "",
+            "remoteuser": getuser(),
+            "remotehost": "",
+            "remotedirectory": "",
+            "syncmode": "both",
+            # Fan-out: more destinations like the remote one, as dicts with
+            # its user, host and directory
+            "mirrors": [],
+            # Snapshots: how many to keep, as a dict of "hourly", "daily"
+            # and "weekly" counts; or None for plain syncs
+            "snapshots": None,
+            # How many times to retry runs that failed in ways that may be
+            # transient (see resilientsteps())
+            "retries": 0,
+            # How sends go, see legsteps(): in how many parallel streams,
+            # and whether by the index (and with it hashing files)
+            "streams": 1,
+            "indexed": False,
+            "hashing": False,
+            # Whether to reuse ssh connections, see SSHPool
+            "multiplex": True}
+
+def setarchive(profile, mode):
+    for key in ARCHIVEFLAGS:
+        profile["flags"][key][1] = mode
+
+def configdir(*parts):
+    directory = os.path.join(os.environ.get("XDG_CONFIG_HOME")
+                             or os.path.expanduser("~/.config"),
+                             "tkrsync", *parts)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def buildcommand(profile, capabilities=None):
+    # capabilities, if given, are as negotiate() returns
+    command = ["rsync"] \
+              + [flag for flag, value in profile["flags"].values() if value] \
+              + [value for value in profile["choices"].values() if value]
+    if capabilities is not None:
+        command = tunecommand(command, capabilities)
+    if profile.get("retries"):
+        # Retrying only pays if attempts leave something to resume, and
+        # stalls time out rather than hang
+        if not any(arg.startswith(("--partial", "--append", "--inplace"))
+                   for arg in command):
+            command.append(FLAGS["partial"])
+        if not any(arg.startswith("--timeout=") for arg in command):
+            command.append("--timeout={}".format(RESILIENT_TIMEOUT))
+    return command
+
+def userhost(user, host):
+    return "{}@{}".format(user, host) if user else host
+
+def destination(user, host, directory):
+    # As rsync takes it; without a host, a local directory
+    if not host:
+        return directory
+    return "{}:{}".format(userhost(user, host), directory)
+
+def subpath(destination, name):
+    # destination may be "host:" or "dir/", either of which takes name as is
+    if not destination or destination.endswith((":", "/")):
+        return destination + name
+    return destination + "/" + name
+
+def endpoints(profile):
+    local = profile["localpath"]
+    remote = destination(profile["remoteuser"], profile["remotehost"],
+                         profile["remotedirectory"])
+    # Trailing slash on the source: sync directory contents, rather than the
+    # directory itself into the destination.
+    send = ("send", local.rstrip("/") + "/", remote)
+    # "host:" is the remote home directory, and not to become "host:/"
+    receive = ("receive",
+               remote if remote.endswith(":") else remote.rstrip("/") + "/",
+               local)
+    return {"send": [send],
+            "receive": [receive],
+            "both": [send, receive]}[profile["syncmode"]]
+
+def syncpair(profile):
+    # What no two syncs are to be running on at once: the local tree and
+    # the remote one, whichever the direction
+    return (os.path.normpath(profile["localpath"]),
+            destination(profile["remoteuser"], profile["remotehost"],
+                        profile["remotedirectory"].rstrip("/")))
+
+def checksnapshots(profile):
+    # Snapshots are only taken sending: receiving the destination back
+    # would copy every snapshot into the local tree.
+    if profile["snapshots"] and profile["syncmode"] != "send":
+        raise ValueError("Snapshots need sync mode send")
+
+def _jobsfile():
+    return os.path.join(configdir(), "jobs.json")
+
+def completeprofile(saved):
+    # A saved profile with the settings it lacks (e.g. saved before they
+    # existed) at their defaults
+    saved = dict(saved)
+    profile = defaultprofile()
+    profile["flags"].update(saved.pop("flags", {}))
+    profile["choices"].update(saved.pop("choices", {}))
+    profile.update(saved)
+    return profile
+
+def loadjobs():
+    try:
+        with open(_jobsfile()) as f:
+            return [completeprofile(job) for job in json.load(f)]
+    except FileNotFoundError:
+        return []
+
+def savejobs(profiles):
+    path = _jobsfile()
+    with open(path + ".new", "w") as f:
+        json.dump(profiles, f, indent=2)
+    os.replace(path + ".new", path)
+
+# --- Parsing rsync's output --- #
+
+# e.g. "    1,238,099,968  99%  117.93MB/s    0:00:10 (xfr#3, to-chk=0/5)"
+_PROGRESS = re.compile(r"\s*(?P<bytes>[\d,.]+)(?P<bytesunit>[KMGTP]?)"
+                       r"\s+(?P<percent>\d+)%"
+                       r"\s+(?P<rate>[\d,.]+)(?P<rateunit>[kKMGTP]?)B/s"
+                       r"\s+(?:(?P<h>\d+):(?P<m>\d\d):(?P<s>\d\d)|\S+)"
+                       r"(?:\s+\((?:xfr#(?P<files>\d+), )?"
+                       r"(?:ir|to)-chk=(?P<remaining>\d+)/(?P<total>\d+)\))?")
+_UNITS = {"": 1, "k": 1 << 10, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30,
+          "T": 1 << 40, "P": 1 << 50}
+
+def _number(digits, unit):
+    return float(digits.replace(",", "")) * _UNITS[unit]
+
+class ProgressParser:
+    # Incremental parser for rsync's --info=progress2 output, which rewrites
+    # one status line with carriage returns. Every record is cumulative, so
+    # per chunk only the last complete one needs parsing; everything before
+    # it is skipped without being split or buffered.
+    _MAXPARTIAL = 1 << 12
+    _LOOKBACK = 4  # records, in case the last one is a file name
+
+    def __init__(self):
+        self.partial = ""
+        self.bytes = 0
+        self.percent = 0
+        self.rate = 0.0
+        self.eta = None
+        self.files = 0
+        self.remaining = None
+        self.total = None
+        self.updated = False
+
+    @classmethod
+    def combine(cls, parsers):
+        # Aggregate view over concurrent transfers
+        combined = cls()
+        total = 0
+        for parser in parsers:
+            combined.bytes += parser.bytes
+            combined.rate += parser.rate
+            combined.files += parser.files
+            if parser.eta is not None:
+                combined.eta = max(combined.eta or 0, parser.eta)
+            total += parser.bytes * 100 // parser.percent if parser.percent \
+                     else parser.bytes
+        combined.percent = combined.bytes * 100 // total if total else 0
+        combined.updated = any(parser.updated for parser in parsers)
+        return combined
+
+    def feed(self, text):
+        end = max(text.rfind("\r"), text.rfind("\n"))
+        if end < 0:
+            self.partial = (self.partial + text)[-self._MAXPARTIAL:]
+            return
+        for _ in range(self._LOOKBACK):
+            start = max(text.rfind("\r", 0, end), text.rfind("\n", 0, end))
+            record = text[start + 1:end] if start >= 0 \
+                     else self.partial + text[:end]
+            if self._parse(record) or start < 0:
+                break
+            end = start
+        self.partial = text[max(text.rfind("\r"),
+                                text.rfind("\n")) + 1:][-self._MAXPARTIAL:]
+
+    def _parse(self, record):
+        match = _PROGRESS.match(record)
+        if match is None:
+            return False
+        self.bytes = int(_number(match["bytes"], match["bytesunit"]))
+        self.percent = int(match["percent"])
+        self.rate = _number(match["rate"], match["rateunit"])
+        if match["h"] is not None:
+            self.eta = int(match["h"]) * 3600 + int(match["m"]) * 60 \
+                       + int(match["s"])
+        else:
+            self.eta = None
+        if match["files"] is not None:
+            self.files = int(match["files"])
+        if match["total"] is not None:
+            self.remaining = int(match["remaining"])
+            self.total = int(match["total"])
+        self.updated = True
+        return True
+
+class ProgressMeter:
+    # Samples a ProgressParser at redraw time, for the rates rsync itself
+    # doesn't report (files/s), smoothed so the labels don't flicker.
+    _SMOOTHING = 0.3
+
+    def __init__(self):
+        self.sample = None
+        self.filerate = 0.0
+
+    def update(self, parser, now=None):
+        now = time.monotonic() if now is None else now
+        if self.sample is not None:
+            then, files = self.sample
+            if now > then:
+                rate = max(parser.files - files, 0) / (now - then)
+                self.filerate += self._SMOOTHING * (rate - self.filerate)
+        self.sample = (now, parser.files)
+        return self.filerate
+
+def human(n, suffix="B"):
+    for unit in ["", "Ki", "Mi", "Gi", "Ti"]:
+        if abs(n) < 1024:
+            break
+        n /= 1024
+    return "{:.1f} {}{}".format(n, unit, suffix)
+
+def duration(seconds):
+    if seconds is None:
+        return "–"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+
+# Output of a dry run with --out-format="%i %l %n", e.g.
+# ">f+++++++++ 1234 dir/file" or "*deleting 0 dir/old"
+_ITEMIZED = re.compile(r"(?P<item>\*deleting|[<>ch.][fdLDS]\S*) +"
+                       r"(?P<size>\d+) (?P<name>.*)")
+# --stats, e.g. "Total transferred file size: 1,234 bytes"
+_STATS = re.compile(r"(?P<name>[A-Z][\w ]+): (?P<value>[\d,.]+)")
+
+class Plan:
+    # What a sync would do, from the itemized output of a dry run. Fed
+    # incrementally from the dry run's reader thread.
+    _LARGEST = 10
+
+    def __init__(self):
+        self.creates = []
+        self.updates = []
+        self.deletes = []
+        self.bytes = 0
+        self.largest = []  # min-heap of (size, name)
+        self.stats = {}
+        self.partial = ""
+
+    def feed(self, text):
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self._parse(line)
+
+    def close(self):
+        if self.partial:
+            self._parse(self.partial)
+            self.partial = ""
+        self.largest.sort(reverse=True)
+        transferred = self.stats.get("Total transferred file size")
+        if transferred is not None:
+            self.bytes = transferred
+
+    def _parse(self, line):
+        match = _ITEMIZED.match(line)
+        if match is None:
+            match = _STATS.match(line)
+            if match is not None:
+                self.stats[match["name"]] = int(float(match["value"]
+                                                      .replace(",", "")))
+            return
+        item, name = match["item"], match["name"]
+        if item == "*deleting":
+            self.deletes.append(name)
+            return
+        if "+++" in item:
+            self.creates.append(name)
+        else:
+            self.updates.append(name)
+        if item[0] in "<>":
+            size = int(match["size"])
+            self.bytes += size
+            if len(self.largest) < self._LARGEST:
+                heapq.heappush(self.largest, (size, name))
+            else:
+                heapq.heappushpop(self.largest, (size, name))
+
+    @property
+    def files(self):
+        return self.creates + self.updates
+
+    def summary(self):
+        lines = ["{} to create, {} to update, {} to delete."
+                 .format(len(self.creates), len(self.updates),
+                         len(self.deletes)),
+                 "{} to transfer.".format(human(self.bytes))]
+        if self.largest:
+            lines.append("Largest:")
+            lines.extend("\t{}\t{}".format(human(size), name)
+                         for size, name in self.largest)
+        return "\n".join(lines)
+
+def planargv(command):
+    return command[:1] + ["--dry-run", "--itemize-changes", "--stats",
+                          "--out-format=%i %l %n"] \
+           + [arg for arg in command[1:]
+              if arg not in ("--info=progress2", "--progress")]
+
+# Flags that change how, but not which, files are transferred; they're left
+# out of plan cache keys so tweaking them doesn't force a rescan.
+_PLAN_NEUTRAL = ("--info=", "--progress", "--stats", "--compress",
+                 "--skip-compress=", "--whole-file", "--sparse",
+                 "--preallocate", "--inplace", "--block-size=", "--bwlimit=",
+                 "--timeout=", "--verbose", "--human-readable", "--rsh=",
+                 "--partial-dir=", "--append-verify",
+                 "--checksum-choice=")
+
+def plankey(command, fingerprint):
+    return (tuple(arg for arg in command
+                  if not arg.startswith(_PLAN_NEUTRAL)),
+            fingerprint)
+
+class PlanCache(OrderedDict):
+    # Least recently used plans are dropped beyond a handful
+    _MAXPLANS = 8
+
+    def get(self, key):
+        plan = super().get(key)
+        if plan is not None:
+            self.move_to_end(key)
+        return plan
+
+    def __setitem__(self, key, plan):
+        super().__setitem__(key, plan)
+        self.move_to_end(key)
+        while len(self) > self._MAXPLANS:
+            self.popitem(last=False)
+
+# --- Running rsync --- #
+
+# How many chunks of output a job hands out per poll, so a chatty
+# transfer can't starve whoever's polling (e.g. Tk's mainloop).
+_POLL_BATCH = 256
+
+class RsyncProcess:
+    # One rsync invocation, run in its own process group so pausing and
+    # cancelling reach the children rsync forks (receiver, generator, ssh).
+    # Output is read in raw chunks by daemon threads and pushed onto the
+    # owning job's event queue as (tag, stream, text) triples; the Tk thread
+    # never blocks on the pipes.
+    # If given, output is called with stdout text (from a reader thread)
+    # instead of it being queued, for output that's parsed rather than shown;
+    # observe is called with it as well as it being queued.
+    # input is a file to feed rsync's standard input from.
+    # record is what to record the run's metrics under (see RunMetrics):
+    # (rsync command without paths, source, destination), by default from
+    # argv; False for runs not to be recorded, e.g. housekeeping. Runs to
+    # record are announced by a "record" event of those, the command as a
+    # string, after their "start" event.
+    def __init__(self, argv, tag=None, output=None, input=None,
+                 observe=None, record=True):
+        self.argv = list(argv)
+        self.tag = tag
+        self.output = output
+        self.input = input
+        self.observe = observe
+        self.record = (self.argv[:-2], self.argv[-2], self.argv[-1]) \
+                      if record is True else record
+        self.process = None
+        self.returncode = None
+        self.paused = False
+
+    @property
+    def done(self):
+        return self.returncode is not None
+
+    @property
+    def result(self):
+        return self.returncode
+
+    def start(self, events):
+        stdin = DEVNULL
+        try:
+            if self.input is not None:
+                stdin = open(self.input, "rb")
+            self.process = Popen(self.argv, stdin=stdin, stdout=PIPE,
+                                 stderr=PIPE, bufsize=0,
+                                 start_new_session=True)
+        except OSError as e:
+            events.put((self.tag, "stderr", "Couldn't invoke {}: {}\n"
+                                            .format(self.argv[0], e)))
+            # As a shell would have it
+            self.returncode = 127
+            return
+        finally:
+            # The child has its own copy
+            if stdin is not DEVNULL:
+                stdin.close()
+        command = " ".join(map(quote, self.argv))
+        events.put((self.tag, "start", command))
+        if self.record is not False:
+            recorded, source, destination = self.record
+            events.put((self.tag, "record",
+                        (" ".join(map(quote, recorded)), source,
+                         destination)))
+        readers = [threading.Thread(target=self._read,
+                                    args=(events, stream, pipe),
+                                    daemon=True)
+                   for stream, pipe in [("stdout", self.process.stdout),
+                                        ("stderr", self.process.stderr)]]
+        for reader in readers:
+            reader.start()
+        threading.Thread(target=self._wait, args=(events, readers),
+                         daemon=True).start()
+
+    def _read(self, events, stream, pipe):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        if stream == "stdout" and self.output is not None:
+            emit = self.output
+        elif stream == "stdout" and self.observe is not None:
+            def emit(text):
+                self.observe(text)
+                events.put((self.tag, stream, text))
+        else:
+            emit = lambda text: events.put((self.tag, stream, text))
+        with pipe:
+            for chunk in iter(lambda: pipe.read(1 << 16), b""):
+                emit(decoder.decode(chunk))
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                emit(tail)
+
+    def _wait(self, events, readers):
+        for reader in readers:
+            reader.join()
+        returncode = self.process.wait()
+        events.put((self.tag, "exit", returncode))
+        self.returncode = returncode
+
+    def _signal(self, signum):
+        if self.process is not None and not self.done:
+            try:
+                os.killpg(self.process.pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def pause(self):
+        self._signal(signal.SIGSTOP)
+        self.paused = True
+
+    def resume(self):
+        self._signal(signal.SIGCONT)
+        self.paused = False
+
+    def cancel(self):
+        self._signal(signal.SIGTERM)
+        # A stopped process won't act on SIGTERM until it's continued
+        if self.paused:
+            self.resume()
+
+class RsyncGroup:
+    # Several rsync processes run concurrently as a single step, each tagged
+    # with its index. The group's exit status is the first failure, if any.
+    def __init__(self, processes):
+        self.processes = list(processes)
+        for tag, process in enumerate(self.processes):
+            process.tag = tag
+
+    @property
+    def done(self):
+        return all(process.done for process in self.processes)
+
+    @property
+    def returncode(self):
+        if not self.done:
+            return None
+        return next((process.returncode for process in self.processes
+                     if process.returncode), 0)
+
+    result = returncode
+
+    def start(self, events):
+        for process in self.processes:
+            process.start(events)
+
+    def pause(self):
+        for process in self.processes:
+            process.pause()
+
+    def resume(self):
+        for process in self.processes:
+            process.resume()
+
+    def cancel(self):
+        for process in self.processes:
+            process.cancel()
+
+class Task:
+    # Runs a Python callable off the Tk thread as a job step (e.g. walking a
+    # huge tree); its return value, or exception, is passed back into the
+    # job's generator.
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = False
+
+    def start(self, events):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        try:
+            self.result = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+
+    def pause(self):
+        pass
+
+    resume = cancel = pause
+
+class Delay:
+    # Waits, as a job step (e.g. backing off before a retry). Pausing stops
+    # the clock; cancelling ends the wait.
+    def __init__(self, seconds):
+        self.remaining = seconds
+        self.deadline = None
+        self.result = None
+
+    @property
+    def done(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def start(self, events):
+        self.deadline = time.monotonic() + self.remaining
+
+    def pause(self):
+        if self.deadline is not None:
+            self.remaining = max(self.deadline - time.monotonic(), 0)
+            self.deadline = None
+
+    def resume(self):
+        if self.deadline is None:
+            self.start(None)
+
+    def cancel(self):
+        self.deadline = time.monotonic()
+
+# rsync's exit status when interrupted; that of cancelled jobs, unless their
+# last step failed otherwise
+INTERRUPTED = 20
+
+class RsyncJob:
+    # Drives a generator of steps (e.g. RsyncProcess) one after the other.
+    # Each step's result (for processes, the exit status) is sent back into
+    # the generator, which decides what to run next, and may return the
+    # job's overall exit status.
+    def __init__(self, steps):
+        self.steps = steps
+        # Bounded, so a runaway transfer is throttled by its own pipe rather
+        # than by our memory.
+        self.events = queue.Queue(maxsize=1024)
+        self.step = None
+        self.returncode = None
+        self.error = None
+        self.cancelled = False
+        self.paused = False
+
+    @property
+    def done(self):
+        return self.returncode is not None
+
+    def start(self):
+        self._advance(None)
+        return self
+
+    def _advance(self, result, error=None):
+        try:
+            if self.cancelled:
+                # Not 0, even cancelled between steps, e.g. backing off. Only
+                # processes' results are exit statuses: Tasks' are anything.
+                self.steps.close()
+                process = isinstance(self.step, (RsyncProcess, RsyncGroup))
+                raise StopIteration(result if process and result
+                                    else INTERRUPTED)
+            if error is not None:
+                self.step = self.steps.throw(error)
+            else:
+                self.step = self.steps.send(result)
+        except StopIteration as e:
+            self.step = None
+            self.returncode = e.value if e.value is not None \
+                              else (result or 0)
+        except Exception as e:
+            # e.g. an unreadable source tree, from a Task
+            self.step = None
+            self.error = e
+            self.returncode = -1
+        else:
+            self.events.put((None, "step", self.step))
+            self.step.start(self.events)
+            if self.paused:
+                self.step.pause()
+
+    def poll(self, limit=_POLL_BATCH):
+        # A step only counts as finished once everything it queued before
+        # finishing has been handed out.
+        finished = self.step is not None and self.step.done
+        events = []
+        try:
+            while len(events) < limit:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            if finished:
+                self._advance(self.step.result,
+                              getattr(self.step, "error", None))
+        return events
+
+    def pause(self):
+        self.paused = True
+        if self.step is not None:
+            self.step.pause()
+
+    def resume(self):
+        self.paused = False
+        if self.step is not None:
+            self.step.resume()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.step is not None:
+            self.step.cancel()
+
+# rsync exit statuses worth retrying, as they may be down to a flaky
+# link: protocol data stream errors (12), partial transfers (23), I/O
+# timeouts (30, 35), and lost ssh connections (255)
+RETRYABLE = (12, 23, 30, 35, 255)
+RESILIENT_TIMEOUT = 300  # s, --timeout if none is set
+_BACKOFF = 5  # s, doubling after each failed attempt
+_BACKOFF_MAX = 600  # s
+
+def resilientsteps(argv, retries, report, tag=None):
+    # Steps running argv, and again after failures that may be transient,
+    # backing off exponentially in between. Partial files (--partial-dir)
+    # make each attempt pick up where the last one left off. report is
+    # filled in with the number of "attempts", and the bytes "resumed":
+    # data retries found at the receiver rather than sent (their --stats
+    # matched data), which restarting from scratch would have resent.
+    report.update(attempts=0, resumed=0)
+    for attempt in count():
+        metrics = RunMetrics(" ".join(map(quote, argv[:-2])), *argv[-2:])
+        returncode = yield RsyncProcess(argv, tag, observe=metrics.feed)
+        report["attempts"] += 1
+        if attempt:
+            report["resumed"] += metrics.stats.get("Matched data", 0)
+        if returncode not in RETRYABLE or attempt >= retries:
+            return returncode
+        yield Delay(min(_BACKOFF * 2 ** attempt, _BACKOFF_MAX))
+
+# --- Logs --- #
+
+_LOG_LINES = 5000  # kept in memory, per run
+_LOG_FILES = 20  # runs' logs kept on disk
+
+# For filtering logs
+LOGFILTERS = {"errors": re.compile(r"error|fail|denied|vanished"
+                                   r"|exited with status", re.IGNORECASE),
+              "deletions": re.compile(r"\*?deleting ")}
+
+def _overwritten(text):
+    # What's left of a line as a terminal shows it: --info=progress2
+    # records overwrite each other with carriage returns.
+    return text[text.rfind("\r", 0, len(text) - 1) + 1:]
+
+def logpath():
+    # A new file for a run's log. Older ones are pruned.
+    directory = cachedir("logs")
+    names = sorted(os.listdir(directory))
+    for name in names[:max(len(names) - _LOG_FILES + 1, 0)]:
+        try:
+            os.unlink(os.path.join(directory, name))
+        except OSError:
+            pass
+    fd, path = mkstemp(prefix=time.strftime("%Y%m%d-%H%M%S-"),
+                       suffix=".log.gz", dir=directory)
+    os.close(fd)
+    return path
+
+class LogBuffer:
+    # A run's output as lines: the last few in memory, for display, and all
+    # of them in a gzipped file at path, to search. Output is written as it
+    # comes, chunks of different tags' streams interleaved; drain() returns
+    # the lines completed since the last call.
+    def __init__(self, path, lines=_LOG_LINES):
+        self.path = path
+        self.lines = deque(maxlen=lines)
+        self.fresh = 0  # lines since the last drain()
+        self.partial = {}  # tag -> incomplete last line
+        self.file = None
+
+    def write(self, text, tag=None, stream=None):
+        key = (tag, stream)
+        lines = (self.partial.pop(key, "") + text).split("\n")
+        rest = _overwritten(lines.pop())
+        if rest:
+            self.partial[key] = rest
+        if not lines:
+            return
+        lines = [_overwritten(line).rstrip("\r") for line in lines]
+        if self.file is None:
+            import gzip
+            self.file = gzip.open(self.path, "at", encoding="utf-8",
+                                  errors="replace")
+        self.file.write("\n".join(lines) + "\n")
+        self.lines.extend(lines)
+        self.fresh += len(lines)
+
+    def end(self, tag=None):
+        # Completes tag's last lines, should its output not have
+        for key in list(self.partial):
+            if key[0] == tag:
+                self.write("\n", *key)
+
+    def drain(self):
+        # Returns (lines, overflowed): lines completed since the last call,
+        # as far as they're still in memory, and whether any weren't.
+        fresh, self.fresh = self.fresh, 0
+        overflowed = fresh > len(self.lines)
+        return list(self.lines)[-fresh:] if fresh else [], overflowed
+
+    def flush(self):
+        # Makes everything written so far readable to searchlog()
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        for key in list(self.partial):
+            self.write("\n", *key)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def searchlog(path, needle="", kind=None):
+    # Streams the lines of a LogBuffer's file containing needle (ignoring
+    # case) and, if given, matching LOGFILTERS[kind]. Runs' logs can be
+    # searched while still being written, up to their last flush().
+    import gzip
+    needle = needle.lower()
+    pattern = LOGFILTERS[kind] if kind else None
+    try:
+        with gzip.open(path, "rt", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                if needle in line.lower() \
+                   and (pattern is None or pattern.search(line)):
+                    yield line.rstrip("\n")
+    except (FileNotFoundError, EOFError):
+        # Nothing written yet, or the end of what has been
+        pass
+
+# --- Run metrics --- #
+
+# The end of --stats output, e.g. "total size is 1,234  speedup is 5.19"
+_SPEEDUP = re.compile(r"total size is [\d,.]+ +"
+                      r"speedup is (?P<speedup>[\d,.]+)")
+# --stats fields recorded, by metric
+_RUNSTATS = {"files": "Number of regular files transferred",
+             "deleted": "Number of deleted files",
+             "size": "Total file size",
+             "transferred": "Total transferred file size",
+             "literal": "Literal data",
+             "matched": "Matched data",
+             "sent": "Total bytes sent",
+             "received": "Total bytes received"}
+# Arguments that differ between otherwise identical runs
+_METRICS_NEUTRAL = ("--rsh=", "--files-from=", "--bwlimit=")
+
+class RunMetrics:
+    # Performance of one rsync run, from timestamps taken as its events are
+    # polled and its --stats output; finish() returns them as a (JSON-able)
+    # dict. Phases:
+    # - filelist: rsync's own file list generation and transfer times
+    # - deletion: with --delete-before, until the first progress record,
+    #   and with --delete-after, from the last one on; so an estimate, and
+    #   only with --info=progress2
+    # - transfer: the rest
+    def __init__(self, command, source, destination, now=None):
+        # command: the rsync command line, without source and destination
+        self.time = time.time()
+        self.started = time.monotonic() if now is None else now
+        self.source = source
+        self.destination = destination
+        self.command = [arg for arg in split(command)
+                        if not arg.startswith(_METRICS_NEUTRAL)]
+        self.stats = {}
+        self.speedup = None
+        self.partial = ""
+        self.firstprogress = self.lastprogress = None
+
+    def feed(self, text, now=None):
+        now = time.monotonic() if now is None else now
+        if "\r" in text:
+            if self.firstprogress is None:
+                self.firstprogress = now
+            self.lastprogress = now
+        lines = (self.partial + text).split("\n")
+        # Progress records don't end lines, and needn't pile up
+        self.partial = _overwritten(lines.pop())
+        for line in lines:
+            match = _STATS.match(line)
+            if match is not None:
+                value = float(match["value"].replace(",", ""))
+                self.stats[match["name"]] = int(value) \
+                                            if value.is_integer() else value
+                continue
+            match = _SPEEDUP.match(line)
+            if match is not None:
+                self.speedup = float(match["speedup"].replace(",", ""))
+
+    def finish(self, returncode, now=None):
+        now = time.monotonic() if now is None else now
+        wall = now - self.started
+        filelist = self.stats.get("File list generation time", 0) \
+                   + self.stats.get("File list transfer time", 0)
+        deletion = None
+        if self.firstprogress is not None:
+            if "--delete-before" in self.command:
+                deletion = max(self.firstprogress - self.started - filelist,
+                               0)
+            elif "--delete-after" in self.command:
+                deletion = now - self.lastprogress
+        transfer = max(wall - filelist - (deletion or 0), 0)
+        metrics = {"time": self.time,
+                   "command": self.command,
+                   "source": self.source,
+                   "destination": self.destination,
+                   "returncode": returncode,
+                   "wall": wall,
+                   "filelist": filelist,
+                   "transfer": transfer,
+                   "deletion": deletion,
+                   "speedup": self.speedup}
+        for metric, name in _RUNSTATS.items():
+            metrics[metric] = self.stats.get(name)
+        metrics["filespersecond"] = (metrics["files"] or 0) / wall \
+                                    if wall else None
+        return metrics
+
+def _historyfile():
+    return os.path.join(datadir(), "history.jsonl")
+
+def recordrun(metrics):
+    # Runs are only ever appended: one line is one write, so concurrent
+    # runs (the job queue) don't interleave.
+    with open(_historyfile(), "a") as f:
+        f.write(json.dumps(metrics) + "\n")
+
+def loadhistory(since=0):
+    try:
+        with open(_historyfile()) as f:
+            for line in f:
+                try:
+                    metrics = json.loads(line)
+                except ValueError:
+                    # A run cut short while recording
+                    continue
+                if metrics["time"] >= since:
+                    yield metrics
+    except FileNotFoundError:
+        pass
+
+# Prometheus metrics exported, by run metric: name, help
+_PROMETHEUS = [("wall", "tkrsync_run_duration_seconds",
+                "Wall clock time of the last run."),
+               ("filelist", "tkrsync_run_filelist_seconds",
+                "File list generation and transfer time of the last run."),
+               ("transfer", "tkrsync_run_transfer_seconds",
+                "Delta transfer time of the last run."),
+               ("deletion", "tkrsync_run_deletion_seconds",
+                "Estimated deletion time of the last run."),
+               ("sent", "tkrsync_run_sent_bytes",
+                "Bytes sent by the last run."),
+               ("received", "tkrsync_run_received_bytes",
+                "Bytes received by the last run."),
+               ("literal", "tkrsync_run_literal_bytes",
+                "Literal (unmatched) data of the last run."),
+               ("matched", "tkrsync_run_matched_bytes",
+                "Data matched by the delta-transfer algorithm in the last"
+                " run."),
+               ("speedup", "tkrsync_run_speedup_ratio",
+                "rsync's speedup of the last run."),
+               ("files", "tkrsync_run_files",
+                "Regular files transferred by the last run."),
+               ("filespersecond", "tkrsync_run_files_per_second",
+                "Files transferred per second by the last run."),
+               ("returncode", "tkrsync_run_exit_code",
+                "rsync's exit status for the last run."),
+               ("time", "tkrsync_run_timestamp_seconds",
+                "When the last run started.")]
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"") \
+                .replace("\n", "\\n")
+
+def prometheus(history):
+    # The text exposition format, e.g. for node_exporter's textfile
+    # collector: the last run of each source and destination pair.
+    last = {}
+    for metrics in history:
+        last[(metrics["source"], metrics["destination"])] = metrics
+    lines = []
+    for metric, name, description in _PROMETHEUS:
+        lines += ["# HELP {} {}".format(name, description),
+                  "# TYPE {} gauge".format(name)]
+        for (source, destination), metrics in sorted(last.items()):
+            if metrics.get(metric) is None:
+                continue
+            lines.append('{}{{source="{}",destination="{}"}} {}'
+                         .format(name, _label(source), _label(destination),
+                                 metrics[metric]))
+    return "\n".join(lines) + "\n"
+
+def exporthistory(path, format="jsonl", since=0):
+    history = loadhistory(since)
+    with open(path + ".new", "w") as f:
+        if format == "prometheus":
+            f.write(prometheus(history))
+        else:
+            for metrics in history:
+                f.write(json.dumps(metrics) + "\n")
+    # Atomically, as textfile collectors want it
+    os.replace(path + ".new", path)
+
+# --- Source trees --- #
+
+def walk(root, recursive=True, directories=False):
+    # Yields (relative path, stat) for every non-directory below root, and
+    # directories too if asked for.
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        with os.scandir(os.path.join(root, relative)) as entries:
+            for entry in entries:
+                path = os.path.join(relative, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        stack.append(path)
+                    if not directories:
+                        continue
+                yield path, entry.stat(follow_symlinks=False)
+
+def fingerprint(root, recursive=True):
+    # Order-independent digest of the tree's shape, sizes and mtimes.
+    # Directory mtimes catch entries being added, removed or renamed.
+    digest = 0
+    for path, stat in walk(root, recursive, directories=True):
+        digest = (digest + hash((path, stat.st_size, stat.st_mtime_ns))) \
+                 & 0xFFFFFFFFFFFFFFFF
+    return digest
+
+# Shards are balanced twice over: once by bytes for large files, whose cost
+# is transfer time, and once by count for swarms of small files, whose cost
+# is mostly per-file round trips. Small files are kept in runs, in walk
+# order, so each shard still sees mostly whole directories.
+_LARGE_FILE = 1 << 26
+_PER_FILE_COST = 1 << 15
+_RUNS_PER_SHARD = 8
+
+def shard(files, n):
+    shards = [[] for _ in range(n)]
+    large = []
+    small = []
+    for path, size in files:
+        (large if size >= _LARGE_FILE else small).append((path, size))
+
+    loads = [(0, index) for index in range(n)]
+    for path, size in sorted(large, key=lambda file: file[1], reverse=True):
+        load, index = heapq.heappop(loads)
+        shards[index].append(path)
+        heapq.heappush(loads, (load + size, index))
+
+    cost = sum(size + _PER_FILE_COST for _, size in small)
+    target = max(cost // (n * _RUNS_PER_SHARD), 1)
+    loads = [(0, index) for index in range(n)]
+    run = []
+    runcost = 0
+    for i, (path, size) in enumerate(small):
+        run.append(path)
+        runcost += size + _PER_FILE_COST
+        if runcost >= target or i == len(small) - 1:
+            load, index = heapq.heappop(loads)
+            shards[index].extend(run)
+            heapq.heappush(loads, (load + runcost, index))
+            run = []
+            runcost = 0
+    return [shard for shard in shards if shard]
+
+def filesfrom(paths):
+    # NUL-separated, for --from0, so any file name survives
+    with NamedTemporaryFile("wb", prefix="tkrsync-", suffix=".files",
+                            delete=False) as f:
+        for path in paths:
+            f.write(os.fsencode(path) + b"\0")
+    return f.name
+
+def datadir(*parts):
+    directory = os.path.join(os.environ.get("XDG_DATA_HOME")
+                             or os.path.expanduser("~/.local/share"),
+                             "tkrsync", *parts)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def cachedir(*parts):
+    directory = os.path.join(os.environ.get("XDG_CACHE_HOME")
+                             or os.path.expanduser("~/.cache"),
+                             "tkrsync", *parts)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+def _scandir(root, relative):
+    # One directory's worth of a Manifest scan: ({path: (size, mtime,
+    # inode)}, [subdirectories], [regular files]). Directories are entries
+    # too, as their mtimes change when they gain or lose entries.
+    entries = {}
+    directories = []
+    files = []
+    with os.scandir(os.path.join(root, relative)) as it:
+        for entry in it:
+            path = os.path.join(relative, entry.name)
+            stat = entry.stat(follow_symlinks=False)
+            entries[path] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(path)
+            elif S_ISREG(stat.st_mode):
+                files.append(path)
+    return entries, directories, files
+
+def _digest(path):
+    # None if it's no longer a regular file (nor any file) since the scan:
+    # not following symlinks, nor blocking on FIFOs
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK)
+    except OSError:
+        return None
+    with open(fd, "rb") as f:
+        if not S_ISREG(os.fstat(fd).st_mode):
+            return None
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    # On-disk index (SQLite) of a source tree as of its last successful sync
+    # to a given destination: path, size, mtime, inode and, optionally, a
+    # content hash. Diffing a fresh scan against it gives the paths a sync
+    # needs to touch, without rsync building and comparing full file lists.
+    _WORKERS = 8
+
+    def __init__(self, root, destination, hashing=False):
+        self.root = root
+        self.hashing = hashing
+        name = hashlib.sha1("{}\0{}".format(os.path.realpath(root),
+                                            destination).encode()).hexdigest()
+        self.path = os.path.join(cachedir("manifests"), name + ".sqlite")
+
+    def _load(self):
+        # {path: (size, mtime, inode, digest)} as of the last commit, or
+        # None if there's been none
+        import sqlite3
+        if not os.path.exists(self.path):
+            return None
+        db = sqlite3.connect(self.path)
+        try:
+            return {path: tuple(entry) for path, *entry
+                    in db.execute("SELECT path, size, mtime, inode, digest"
+                                  " FROM files")}
+        finally:
+            db.close()
+
+    def scan(self, recursive=True, known=None):
+        # Directories are listed in parallel: scandir/stat release the GIL,
+        # which pays off on cold caches and network filesystems. When
+        # hashing, files whose size, mtime and inode match what's known
+        # (as _load() returns) keep their digest, and only the rest are
+        # read. Only regular files are hashed: symlinks, directories, FIFOs
+        # and the like get None.
+        from concurrent.futures import ThreadPoolExecutor, wait, \
+                                       FIRST_COMPLETED
+        known = known or {}
+        entries = {}
+        regular = set()
+        with ThreadPoolExecutor(self._WORKERS) as pool:
+            pending = {pool.submit(_scandir, self.root, "")}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    found, directories, files = future.result()
+                    entries.update(found)
+                    regular.update(files)
+                    if recursive:
+                        pending.update(pool.submit(_scandir, self.root, path)
+                                       for path in directories)
+            if self.hashing:
+                paths = []
+                for path, entry in entries.items():
+                    old = known.get(path)
+                    if path not in regular:
+                        entries[path] += (None,)
+                    elif old is not None and old[:3] == entry \
+                         and old[3] is not None:
+                        entries[path] += old[3:]
+                    else:
+                        paths.append(path)
+                for path, digest in zip(paths, pool.map(
+                        _digest, (os.path.join(self.root, path)
+                                  for path in paths), chunksize=64)):
+                    entries[path] += (digest,)
+        return entries
+
+    def diff(self, recursive=True):
+        # Returns (changed, deleted, entries), or None without a manifest
+        # to diff against, i.e. on a first run.
+        known = self._load()
+        entries = self.scan(recursive, known)
+        if known is None:
+            return None, None, entries
+        changed = []
+        deleted = []
+        for path, old in known.items():
+            new = entries.get(path)
+            if new is None:
+                deleted.append(path)
+            elif old[:len(new)] != new:
+                # When hashing, files whose contents are as they were (just
+                # touched, or rewritten unchanged) needn't be sent
+                if len(new) > 3 and new[3] is not None and new[3] == old[3]:
+                    continue
+                changed.append(path)
+        changed.extend(path for path in entries if path not in known)
+        # Deleting a directory takes everything beneath it along
+        deleted.sort()
+        pruned = []
+        for path in deleted:
+            if not pruned or not path.startswith(pruned[-1] + os.sep):
+                pruned.append(path)
+        return changed, pruned, entries
+
+    def commit(self, entries):
+        # Written aside and renamed over, so the manifest is never half
+        # updated, e.g. by a crash.
+        import sqlite3
+        new = self.path + ".new"
+        if os.path.exists(new):
+            os.unlink(new)
+        db = sqlite3.connect(new)
+        with db:
+            db.execute("CREATE TABLE files (path TEXT PRIMARY KEY,"
+                       " size INTEGER, mtime INTEGER, inode INTEGER,"
+                       " digest TEXT)")
+            db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                           ((path,) + entry + (None,) * (4 - len(entry))
+                            for path, entry in entries.items()))
+        db.close()
+        os.replace(new, self.path)
+
+# inotify(7)
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ONLYDIR = 0x1000000
+_IN_DONT_FOLLOW = 0x2000000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_WATCHMASK = _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO \
+             | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF \
+             | _IN_ONLYDIR | _IN_DONT_FOLLOW
+_EVENT = struct.Struct("iIII")
+
+class Watcher:
+    # Watches a tree with inotify, from a thread of its own, and queues
+    # (full, paths) batches once events have been quiet for a debounce
+    # window, or have kept coming for ten of them. paths are relative to
+    # the root, and may since have been deleted; full asks for a complete
+    # pass instead, after events were lost (queue overflow), or while the
+    # watch limit keeps part of the tree unwatched.
+    _MAXLATENCY = 10  # debounce windows
+    _DEGRADED_INTERVAL = 300  # s, between full passes without full coverage
+
+    def __init__(self, root, debounce=2.0):
+        self.root = root
+        self.debounce = debounce
+        self.batches = queue.Queue()
+        self.error = None
+        self.degraded = False
+        self.paths = {}  # watch descriptor -> relative path
+        import ctypes
+        self.ctypes = ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(self.ctypes.get_errno(), "inotify_init1")
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+
+    def _watch(self, relative, dirty=None):
+        # Watches a directory and everything below it, adding it all to
+        # dirty, if given, since it may have been filled before the watches
+        # were in place.
+        stack = [relative]
+        while stack:
+            relative = stack.pop()
+            path = os.path.join(self.root, relative)
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                             _WATCHMASK)
+            if wd < 0:
+                errno = self.ctypes.get_errno()
+                if errno == 28:  # ENOSPC: out of watches
+                    self.degraded = True
+                    self.error = "Out of inotify watches (see sysctl" \
+                                 " fs.inotify.max_user_watches); falling" \
+                                 " back to full passes."
+                    return
+                continue  # gone already, or unreadable
+            self.paths[wd] = relative
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        child = os.path.join(relative, entry.name)
+                        if dirty is not None:
+                            dirty.add(child)
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(child)
+            except OSError:
+                continue
+
+    def _read(self, dirty):
+        # Returns whether events were lost
+        try:
+            buffer = os.read(self.fd, 1 << 20)
+        except BlockingIOError:
+            return False
+        overflowed = False
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & _IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            directory = self.paths.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            dirty.add(path)
+            # Directories' mtimes change with their entries
+            dirty.add(directory)
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self._watch(path, dirty)
+        return overflowed
+
+    def partition(self, paths):
+        # Splits a batch's paths into those to sync and those to delete
+        changed = []
+        deleted = []
+        for path in paths:
+            exists = os.path.lexists(os.path.join(self.root, path))
+            (changed if exists else deleted).append(path or ".")
+        return changed, deleted
+
+    def _run(self):
+        dirty = set()
+        full = True  # to begin with: whatever changed before we watched
+        self._watch("")
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        first = last = lastfull = time.monotonic()
+        try:
+            while not self.stopping:
+                ready = poller.poll(self.debounce * 1000 / 4)
+                now = time.monotonic()
+                if ready:
+                    if self._read(dirty):
+                        full = True
+                    if first is None:
+                        first = now
+                    last = now
+                if self.degraded and now - lastfull >= self._DEGRADED_INTERVAL:
+                    full = True
+                    if first is None:
+                        first = last = now
+                if (full or dirty) \
+                   and (now - last >= self.debounce
+                        or now - first >= self.debounce * self._MAXLATENCY):
+                    self.batches.put((full or self.degraded, dirty))
+                    if full:
+                        lastfull = now
+                    dirty = set()
+                    full = False
+                    first = None
+        finally:
+            os.close(self.fd)
+
+# Auto-tuning: a sample of the source is transferred to a scratch directory
+# at the destination under each of these, and the fastest wins. Runs use
+# --ignore-times so every one does the full work of an update, after an
+# untimed run seeding the scratch directory with basis files. Options that
+# would have rsync skip files regardless (the seeded copies are newer, and
+# the same size), or delete any, are left out of calibration runs.
+AUTOTUNE = [("delta", []),
+             ("whole files", ["--whole-file"]),
+             ("delta, light compression", ["--compress", "--compress-level=1"]),
+             ("delta, compression", ["--compress", "--compress-level=6"]),
+             ("whole files, light compression",
+              ["--whole-file", "--compress", "--compress-level=1"])]
+# Options the calibration runs set, or that would skip or spoil them; those
+# ending in "=" or "-" are prefixes. --checksum-choice= stays, as in real
+# runs, and the --compress-choice= negotiated goes with --compress.
+AUTOTUNE_FLAGS = ("--compress", "--compress-level=", "--compress-choice=",
+                  "--skip-compress=", "--whole-file", "--info=progress2")
+AUTOTUNE_SKIPPING = ("--update", "--checksum", "--size-only", "--delete",
+                     "--delete-")
+AUTOTUNE_SCRATCH = ".tkrsync-autotune"
+_SAMPLE_BYTES = 1 << 25
+_SAMPLE_FILES = 2000
+
+def sample(root, recursive=True):
+    # Returns (paths, bytes), a prefix of the tree up to a budget, skipping
+    # files that would take it all on their own.
+    paths = []
+    total = 0
+    for path, stat in walk(root, recursive):
+        if len(paths) >= _SAMPLE_FILES or total >= _SAMPLE_BYTES:
+            break
+        if stat.st_size <= _SAMPLE_BYTES // 2:
+            paths.append(path)
+            total += stat.st_size
+    return paths, total
+
+def childcpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def autotunesteps(command, source, destination, results, recursive=True):
+    # Steps timing a sample of the source under each of AUTOTUNE; results
+    # is filled in with their (wall, CPU seconds, name, flags). command is
+    # best built with compression on, for the --compress-choice= negotiated.
+    # Returns (exit status, bytes sampled).
+    choice = [arg for arg in command if arg.startswith("--compress-choice=")]
+    command = [arg for arg in command
+               if not any(arg == option
+                          or option.endswith(("=", "-"))
+                          and arg.startswith(option)
+                          for option in AUTOTUNE_FLAGS + AUTOTUNE_SKIPPING)]
+    paths, total = yield Task(sample, source, recursive)
+    if not paths:
+        return 0, 0
+    listing = filesfrom(paths)
+    argv = ["--ignore-times", "--from0", "--files-from=" + listing,
+            source, subpath(destination, AUTOTUNE_SCRATCH)]
+    try:
+        returncode = yield RsyncProcess(command + argv)
+        for name, flags in AUTOTUNE if not returncode else []:
+            cpu = childcpu()
+            start = time.monotonic()
+            returncode = yield RsyncProcess(
+                command + flags
+                + (choice if "--compress" in flags else []) + argv)
+            if returncode:
+                break
+            wall = time.monotonic() - start
+            results.append((wall, childcpu() - cpu, name, flags))
+    finally:
+        os.unlink(listing)
+    # Remove the scratch directory, and nothing else: as snapshots are
+    # pruned, so the destination itself keeps its attributes. (Not from the
+    # finally clause: a cancelled job's generator can't run more steps.)
+    yield from prunesteps(command, destination, [AUTOTUNE_SCRATCH])
+    return returncode, total
+
+# --- Connections --- #
+
+class SSHPool:
+    # Persistent, multiplexed ssh masters (ControlMaster), one per
+    # (user, host), so repeated syncs skip the handshake and authentication.
+    # Runs hand rsync an --rsh command that goes through the master's
+    # control socket, and lease the master meanwhile: 'ssh -O exit' ends
+    # every session going through a master, so leased ones aren't evicted.
+    # ssh is configurable, by default from $TKRSYNC_SSH, so a stand-in
+    # transport script (e.g. tkrsync-localssh) can be used instead.
+    _PERSIST = 600  # s, masters exit by themselves after this long unused
+    _IDLE = 300  # s, we close them earlier than that
+    _TIMEOUT = 10  # s, for control commands
+
+    def __init__(self, ssh=None, idle=_IDLE):
+        self.ssh = list(ssh) if ssh is not None \
+                   else split(os.environ.get("TKRSYNC_SSH") or "ssh")
+        self.idle = idle
+        self.directory = None
+        self.masters = {}  # (user, host) -> last use, monotonic
+        self.users = Counter()  # (user, host) -> leases
+        self.lock = threading.Lock()  # held bringing masters up and down
+        self.leaselock = threading.Lock()
+        atexit.register(self.close)
+
+    def _options(self, user, host):
+        if self.directory is None:
+            # Private, and short: socket paths are limited to ~100 bytes
+            self.directory = mkdtemp(prefix="tkrsync-ssh-")
+        name = hashlib.sha1(userhost(user, host).encode()) \
+                      .hexdigest()[:16]
+        return ["-o", "ControlPath=" + os.path.join(self.directory, name),
+                "-o", "ControlMaster=auto",
+                "-o", "ControlPersist={}".format(self._PERSIST)]
+
+    def _control(self, user, host, command):
+        try:
+            return run(self.ssh + self._options(user, host)
+                       + ["-O", command, userhost(user, host)],
+                       stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+                       timeout=self._TIMEOUT).returncode == 0
+        except TimeoutExpired:
+            return False
+
+    def alive(self, user, host):
+        return self._control(user, host, "check")
+
+    def connect(self, user, host):
+        # Blocking: authentication may take a while, run it as a Task.
+        # Brings up the master if it's not alive, and leases it.
+        with self.lock:
+            if not self.alive(user, host):
+                run(self.ssh + self._options(user, host)
+                    + ["-N", "-f", userhost(user, host)],
+                    stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE, check=True)
+            self.acquire(user, host)
+
+    def acquire(self, user, host):
+        # Leases the master for a run, until release()d
+        with self.leaselock:
+            self.users[(user, host)] += 1
+            self.masters[(user, host)] = time.monotonic()
+
+    def release(self, user, host):
+        with self.leaselock:
+            self.users[(user, host)] -= 1
+            if self.users[(user, host)] <= 0:
+                del self.users[(user, host)]
+            # Idle from now on
+            self.masters[(user, host)] = time.monotonic()
+
+    def rsh(self, user, host):
+        # Should the master have gone away meanwhile, ControlMaster=auto
+        # lets the run bring up a fresh one rather than fail.
+        return " ".join(map(quote, self.ssh + self._options(user, host)))
+
+    def shell(self):
+        # For runs not going through a master: the remote shell command, or
+        # None for rsync's default (ssh)
+        if self.ssh == ["ssh"]:
+            return None
+        return " ".join(map(quote, self.ssh))
+
+    def evict(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for key in list(self.masters):
+                # Held until the master's gone, so no run leases it as it
+                # goes
+                with self.leaselock:
+                    if self.users[key] \
+                       or now - self.masters[key] <= self.idle:
+                        continue
+                    del self.masters[key]
+                    self._control(*key, "exit")
+
+    def close(self):
+        with self.lock:
+            for key in list(self.masters):
+                self._control(*key, "exit")
+            self.masters.clear()
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+                self.directory = None
+
+# --- Capabilities of the rsync at either end --- #
+
+# Fastest first. md5 (md4 before protocol 30) and zlib are what rsync uses
+# when there's no choice to make.
+CHECKSUMS = ["xxh128", "xxh3", "xxh64", "md5", "md4"]
+COMPRESSIONS = ["zstd", "lz4", "zlibx", "zlib"]
+_DEFAULT_ALGORITHMS = ("md5", "md4", "zlib")
+# A remote rsync can't be stat()ed without connecting, which is what the
+# cache saves, so its probes expire instead.
+_PROBE_TTL = 86400  # s
+_PROBE_TIMEOUT = 30  # s
+
+_VERSION = re.compile(r"rsync\s+version\s+v?(?P<version>[\d.]+)\S*"
+                      r"\s+protocol version (?P<protocol>\d+)")
+
+def parseversion(text):
+    # rsync --version output to a (JSON-able) dict of what it can do
+    match = _VERSION.search(text)
+    if match is None:
+        raise ValueError("Not rsync --version output: {!r}"
+                         .format(text[:80]))
+    version = tuple(int(part) for part in match["version"].split(".")
+                    if part)
+    protocol = int(match["protocol"])
+    # Indented lists under "Heading:" lines (3.2 and later)
+    lists = {}
+    heading = None
+    for line in text.splitlines():
+        if line.endswith(":") and not line[:1].isspace():
+            heading = lists.setdefault(line[:-1].strip().lower(), [])
+        elif heading is not None and line[:1].isspace():
+            heading.extend(word for word in line.replace(",", " ").split()
+                           if not word.startswith("("))
+        else:
+            heading = None
+    return {"version": match["version"],
+            "protocol": protocol,
+            "checksums": lists.get("checksum list")
+                         or ["md5" if protocol >= 30 else "md4"],
+            "compressions": lists.get("compress list") or ["zlib"],
+            "progress2": version >= (3, 1),
+            "increcurse": protocol >= 30}
+
+def _probecache():
+    return os.path.join(cachedir(), "capabilities.json")
+
+def _cachedprobe(key, stamp, argv):
+    # stamp identifies the binary; None for remote ones, whose probes expire
+    path = _probecache()
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    entry = cache.get(key)
+    if entry is not None and entry["stamp"] == stamp \
+       and (stamp is not None or time.time() - entry["time"] < _PROBE_TTL):
+        return entry["capabilities"]
+    capabilities = parseversion(run(argv, stdin=DEVNULL, stdout=PIPE,
+                                    stderr=DEVNULL, text=True, check=True,
+                                    timeout=_PROBE_TIMEOUT).stdout)
+    cache[key] = {"stamp": stamp, "time": time.time(),
+                  "capabilities": capabilities}
+    # A file of its own to replace the cache with: probes may run at once
+    # (e.g. queued jobs)
+    fd, new = mkstemp(prefix="capabilities-", suffix=".new", dir=cachedir())
+    with open(fd, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(new, path)
+    return capabilities
+
+def probe(user="", host="", rsh="ssh"):
+    # Blocking, when not cached: run it as a Task. Without a host, probes
+    # the local rsync; rsh is the remote shell command, as for --rsh.
+    if host:
+        destination = userhost(user, host)
+        return _cachedprobe("remote:" + destination, None,
+                            split(rsh)
+                            + [destination, "rsync", "--version"])
+    binary = shutil.which("rsync")
+    if binary is None:
+        raise FileNotFoundError("rsync not found")
+    binary = os.path.realpath(binary)
+    return _cachedprobe("local:" + binary, os.stat(binary).st_mtime_ns,
+                        [binary, "--version"])
+
+def negotiate(local, remote=None):
+    # What both ends can do, and the fastest algorithms they share. With no
+    # remote, both ends are the local rsync.
+    ends = [local] if remote is None else [local, remote]
+    shared = {}
+    for key, lists, preference in [("checksum", "checksums", CHECKSUMS),
+                                   ("compress", "compressions",
+                                    COMPRESSIONS)]:
+        shared[key] = next((name for name in preference
+                            if all(name in end[lists] for end in ends)),
+                           None)
+    # Only the local rsync reports progress
+    shared["progress2"] = local["progress2"]
+    shared["increcurse"] = all(end["increcurse"] for end in ends)
+    return shared
+
+def tunecommand(command, capabilities):
+    command = list(command)
+    if not capabilities["progress2"] and "--info=progress2" in command:
+        command[command.index("--info=progress2")] = "--progress"
+    if capabilities["checksum"] not in (None,) + _DEFAULT_ALGORITHMS:
+        command.append("--checksum-choice=" + capabilities["checksum"])
+    if "--compress" in command \
+       and capabilities["compress"] not in (None,) + _DEFAULT_ALGORITHMS:
+        command.append("--compress-choice=" + capabilities["compress"])
+    return command
+
+def probeends(profile, rsh="ssh"):
+    # Blocking: negotiate() for both ends of a profile's runs
+    local = probe()
+    remote = None
+    if profile["remotehost"]:
+        remote = probe(profile["remoteuser"], profile["remotehost"], rsh)
+    return negotiate(local, remote)
+
+def probesteps(profile, rsh="ssh"):
+    # Steps for an RsyncJob, returning probeends()'s result, or None should
+    # a probe fail: the run will then report what's wrong better than the
+    # probe could.
+    try:
+        return (yield Task(probeends, profile, rsh))
+    except (OSError, ValueError, SubprocessError):
+        return None
+
+# --- Fan-out to mirrors --- #
+
+# rsync exit statuses for a destination that couldn't be reached, rather
+# than one a batch didn't apply to: errors starting the protocol (5), in
+# socket I/O (10), and ssh's own (255)
+_UNREACHABLE = (5, 10, 255)
+# Negotiated with the reference destination's rsync, not the mirrors'
+_TUNED = ("--checksum-choice=", "--compress-choice=")
+
+def mirrordestination(mirror):
+    return destination(mirror["user"], mirror["host"], mirror["directory"])
+
+def _mirrorcommand(command, mirror, rsh):
+    # The reference's --rsh may go through its own ssh master
+    command = [arg for arg in command
+               if not arg.startswith(("--rsh=",) + _TUNED)]
+    if mirror["host"] and rsh is not None:
+        command.append("--rsh=" + rsh(mirror["user"], mirror["host"]))
+    return command
+
+def _readbatch(command, batch, source, mirror, rsh):
+    # Recorded as a sync of source to the mirror
+    if not mirror["host"]:
+        command = _mirrorcommand(command, mirror, rsh) \
+                  + ["--read-batch=" + batch]
+        return RsyncProcess(command + [mirror["directory"]],
+                            record=(command, source,
+                                    mirrordestination(mirror)))
+    # rsync won't read a batch into a remote destination: the remote rsync
+    # reads it itself, from its standard input through the remote shell.
+    remote = command[:1] + ["--read-batch=-"] \
+             + _mirrorcommand(command, mirror, None)[1:] \
+             + [mirror["directory"]]
+    shell = "ssh" if rsh is None else rsh(mirror["user"], mirror["host"])
+    return RsyncProcess(split(shell)
+                        + [userhost(mirror["user"], mirror["host"]),
+                           " ".join(map(quote, remote))],
+                        input=batch,
+                        record=(remote[:-1], source,
+                                mirrordestination(mirror)))
+
+def _bwlimited(command, bwlimit, ways=1):
+    # command limited to its share of bwlimit (KiB/s, None for no limit),
+    # as one of that many rsyncs running at once
+    if bwlimit is None:
+        return command
+    return command + ["--bwlimit={}".format(max(bwlimit // max(ways, 1), 1))]
+
+def fanoutsteps(command, source, reference, mirrors, health, rsh=None,
+                bwlimit=None):
+    # Steps syncing source to the reference destination while recording the
+    # delta in a batch file, then replaying that on all mirrors at once.
+    # That only works on mirrors in the reference's state (e.g. kept so by
+    # fan-outs); those it doesn't apply to get a regular sync instead.
+    # health is filled in with each mirror's destination's (state, exit
+    # status); states are "batch", "synced" (fell back), "unreachable" and
+    # "failed". rsh, if given, is called with a mirror's user and host for
+    # the remote shell command to it. bwlimit (KiB/s) is shared among the
+    # rsyncs running at once.
+    directory = mkdtemp(prefix="batch-", dir=cachedir())
+    batch = os.path.join(directory, "batch")
+    try:
+        returncode = yield RsyncProcess(_bwlimited(command, bwlimit)
+                                        + ["--write-batch=" + batch,
+                                           source, reference])
+        if returncode or not mirrors:
+            return returncode
+        readers = [_readbatch(_bwlimited(command, bwlimit, len(mirrors)),
+                              batch, source, mirror, rsh)
+                   for mirror in mirrors]
+        yield RsyncGroup(readers)
+        diverged = []
+        for mirror, reader in zip(mirrors, readers):
+            if not reader.returncode:
+                health[mirrordestination(mirror)] = ("batch", 0)
+            elif reader.returncode in _UNREACHABLE:
+                health[mirrordestination(mirror)] = ("unreachable",
+                                                     reader.returncode)
+            else:
+                diverged.append(mirror)
+        syncs = [RsyncProcess(_mirrorcommand(_bwlimited(command, bwlimit,
+                                                        len(diverged)),
+                                             mirror, rsh)
+                              + [source, mirrordestination(mirror)])
+                 for mirror in diverged]
+        if syncs:
+            yield RsyncGroup(syncs)
+        for mirror, sync in zip(diverged, syncs):
+            health[mirrordestination(mirror)] = \
+                ("failed" if sync.returncode else "synced", sync.returncode)
+        return next((code for state, code in health.values()
+                     if state in ("unreachable", "failed")), 0)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# --- Snapshots --- #
+
+SNAPSHOT_FORMAT = "%Y-%m-%d-%H%M%S"
+_SNAPSHOT = re.compile(r"\d{4}-\d\d-\d\d-\d{6}$")
+_INCOMPLETE = ".incomplete"  # see snapshotsteps()
+RETENTION = {"hourly": 24, "daily": 7, "weekly": 4}
+# Retention periods, as time.strftime() formats of their buckets
+_PERIODS = [("hourly", "%Y-%m-%d %H"), ("daily", "%Y-%m-%d"),
+            ("weekly", "%G-%V")]
+# rsync exit status for source files that vanished during the run, which
+# doesn't make for an incomplete snapshot
+VANISHED = 24
+
+def _housekeeping(command):
+    # For rsync runs on the destination itself: how to connect, no more
+    return command[:1] + [arg for arg in command[1:]
+                          if arg.startswith("--rsh=")]
+
+def expired(names, retention):
+    # Snapshots beyond retention: of each hour, day and week, the last
+    # snapshot is kept, for as many of the last periods as retention says.
+    # The latest is always kept.
+    names = sorted(names, reverse=True)
+    keep = set(names[:1])
+    for period, bucket in _PERIODS:
+        buckets = set()
+        for name in names:
+            key = time.strftime(bucket, time.strptime(name, SNAPSHOT_FORMAT))
+            if key in buckets:
+                continue
+            if len(buckets) >= retention.get(period, 0):
+                break
+            buckets.add(key)
+            keep.add(name)
+    return [name for name in names if name not in keep]
+
+def prunesteps(command, destination, names):
+    # Steps deleting snapshots (or other directories right under
+    # destination), with rsync itself so remote destinations need nothing
+    # else: syncing an empty directory over the destination with --delete,
+    # and only the snapshots not excluded.
+    if not names:
+        return 0
+    empty = mkdtemp(prefix="empty-", dir=cachedir())
+    try:
+        return (yield RsyncProcess(_housekeeping(command)
+                                   + ["--recursive", "--delete"]
+                                   + ["--include=/{}/***".format(name)
+                                      for name in names]
+                                   + ["--exclude=*", empty + "/",
+                                      subpath(destination, "")],
+                                   record=False))
+    finally:
+        os.rmdir(empty)
+
+def _mkdirsteps(command, directory):
+    # rsync only creates the last directory of a destination path
+    empty = mkdtemp(prefix="empty-", dir=cachedir())
+    try:
+        return (yield RsyncProcess(_housekeeping(command)
+                                   + ["--dirs", empty + "/", directory],
+                                   record=False))
+    finally:
+        os.rmdir(empty)
+
+def snapshotsteps(command, source, destination):
+    # Steps syncing source into a new, timestamped snapshot directory under
+    # destination. Files unchanged since the previous snapshot are
+    # hard-linked to it (--link-dest) rather than copied, so snapshots only
+    # cost what changed. Returns (exit status, snapshot names there now).
+    # A snapshot is incomplete for as long as its marker, a directory next
+    # to it, is there: rsync can't rename remotely. Those of runs cut short
+    # (e.g. cancelled) are pruned by the next run, before they'd be linked
+    # against or kept.
+    listing = []
+    returncode = yield RsyncProcess(_housekeeping(command)
+                                    + ["--list-only",
+                                       subpath(destination, "")],
+                                    output=listing.append, record=False)
+    if returncode:
+        # No destination yet, presumably
+        returncode = yield from _mkdirsteps(command, destination)
+        if returncode:
+            return returncode, []
+    listed = [line.split(None, 4)[-1]
+              for line in "".join(listing).splitlines() if line.strip()]
+    incomplete = [name[:-len(_INCOMPLETE)] for name in listed
+                  if name.endswith(_INCOMPLETE)]
+    names = [name for name in listed
+             if _SNAPSHOT.match(name) and name not in incomplete]
+    returncode = yield from prunesteps(
+        command, destination,
+        [name + suffix for name in incomplete for suffix in ("", _INCOMPLETE)])
+    if returncode:
+        return returncode, names
+    snapshot = time.strftime(SNAPSHOT_FORMAT)
+    marker = snapshot + _INCOMPLETE
+    returncode = yield from _mkdirsteps(command,
+                                        subpath(destination, marker))
+    if returncode:
+        return returncode, names
+    linkdest = ["--link-dest=../" + max(names)] if names else []
+    # Recorded under destination rather than each snapshot's own directory
+    returncode = yield RsyncProcess(command + linkdest
+                                    + [source,
+                                       subpath(destination, snapshot)],
+                                    record=(command + linkdest, source,
+                                            destination))
+    if returncode and returncode != VANISHED:
+        # Incomplete: neither to be kept nor linked against
+        yield from prunesteps(command, destination, [snapshot, marker])
+        return returncode, names
+    yield from prunesteps(command, destination, [marker])
+    return returncode, names + [snapshot]
+
+# --- Syncs: the steps of a profile's sync, for the GUI and the queue --- #
+
+def connectsteps(profile, pool=None, leases=None):
+    # Steps bringing up the profile's ssh master in pool (see SSHPool),
+    # should it reuse connections, and leasing it: (user, host) is appended
+    # to leases, for the caller to release once its runs are over. Returns
+    # the remote shell command for the profile's runs, or None for rsync's
+    # default.
+    user, host = profile["remoteuser"], profile["remotehost"]
+    if pool is None or not host:
+        return None
+    if not profile["multiplex"]:
+        return pool.shell()
+    try:
+        yield Task(pool.connect, user, host)
+    except (OSError, SubprocessError):
+        # Fall back to a connection per run, which will show the error
+        return pool.shell()
+    leases.append((user, host))
+    return pool.rsh(user, host)
+
+def mirrorshell(profile, pool, leases):
+    # For fanoutsteps(): mirrors' remote shell commands, through their
+    # masters in pool should the profile reuse connections; leased as by
+    # connectsteps(). ControlMaster=auto has the first run to a mirror bring
+    # up its master, should there be none.
+    def rsh(user, host):
+        if not profile["multiplex"]:
+            return pool.shell() or "ssh"
+        pool.acquire(user, host)
+        leases.append((user, host))
+        return pool.rsh(user, host)
+    return rsh
+
+def commandsteps(profile, pool=None, leases=None):
+    # Steps returning the profile's command, for the fastest algorithms
+    # both ends support, and through its ssh master if any (see
+    # connectsteps())
+    rsh = yield from connectsteps(profile, pool, leases)
+    capabilities = yield from probesteps(profile, rsh or "ssh")
+    return buildcommand(profile, capabilities) \
+           + (["--rsh=" + rsh] if rsh else [])
+
+def listedsteps(command, paths, source, destination, deleting=False):
+    # Steps syncing exactly the given paths. They include directories as
+    # well as files, so there's nothing left to recurse into. When
+    # deleting, they're paths gone from the source, to be deleted from the
+    # destination.
+    if not paths:
+        return 0
+    command = [arg for arg in command if arg != "--recursive"]
+    if "--dirs" not in command:
+        command.append("--dirs")
+    if deleting:
+        command += ["--delete-missing-args", "--force"]
+    listing = filesfrom(paths)
+    try:
+        return (yield RsyncProcess(command + ["--from0",
+                                              "--files-from=" + listing,
+                                              source, destination]))
+    finally:
+        os.unlink(listing)
+
+def plansteps(command, source, destination, plans, recursive=True):
+    # Steps returning (exit status, Plan) of a dry run, from plans (a
+    # PlanCache) if the tree hasn't changed since it was planned
+    argv = command + [source, destination]
+    key = plankey(argv, (yield Task(fingerprint, source, recursive)))
+    plan = plans.get(key)
+    if plan is None:
+        plan = Plan()
+        returncode = yield RsyncProcess(planargv(argv), output=plan.feed)
+        if returncode:
+            return returncode, None
+        plan.close()
+        plans[key] = plan
+    return 0, plan
+
+def cachedplansteps(command, source, destination, plans, recursive=True):
+    # Steps returning a plan to carry out from plans, if there's one for
+    # the tree as it is, or None
+    # Only worth a fingerprinting walk if there's anything to look up
+    if not plans:
+        return None
+    key = plankey(command + [source, destination],
+                  (yield Task(fingerprint, source, recursive)))
+    plan = plans.get(key)
+    # Deletions need rsync's own full file list
+    if plan is None or plan.deletes:
+        return None
+    # Once carried out, the plan no longer describes the destination
+    del plans[key]
+    return plan
+
+def indexedsteps(command, source, destination, recursive=True,
+                 hashing=False, deleting=False):
+    # Steps syncing what changed since the last time, as found by diffing
+    # the source against its Manifest; deleting is whether paths gone from
+    # the source are to be deleted from the destination.
+    manifest = Manifest(source, destination, hashing)
+    changed, deleted, entries = yield Task(manifest.diff, recursive)
+    if changed is None:
+        # Nothing to go by yet: a regular run, then start indexing
+        returncode = yield RsyncProcess(command + [source, destination])
+    else:
+        returncode = yield from listedsteps(command, changed,
+                                            source, destination)
+        # Deletions only as a regular run would make them
+        if not returncode and deleting:
+            returncode = yield from listedsteps(command, deleted,
+                                                source, destination,
+                                                deleting=True)
+    if not returncode:
+        yield Task(manifest.commit, entries)
+    return returncode
+
+def shardedsteps(command, source, destination, streams, recursive=True,
+                 bwlimit=None):
+    # Steps syncing the source as that many shards at once, sharing bwlimit
+    # (KiB/s)
+    shards = yield Task(lambda: shard(((path, stat.st_size)
+                                       for path, stat
+                                       in walk(source, recursive)),
+                                      streams))
+    listings = [filesfrom(paths) for paths in shards]
+    try:
+        returncode = yield RsyncGroup(
+            RsyncProcess(_bwlimited(command, bwlimit, len(listings))
+                         + ["--from0", "--files-from=" + listing,
+                            source, destination])
+            for listing in listings)
+    finally:
+        for listing in listings:
+            os.unlink(listing)
+    if returncode:
+        return returncode
+    # Finishing pass: the shards only carried files, so directories
+    # (attributes, empty ones) and deletions are left to a regular run,
+    # which by now finds file data up to date.
+    return (yield RsyncProcess(_bwlimited(command, bwlimit)
+                               + [source, destination]))
+
+def legsteps(profile, command, leg, health, resumption, plans=None,
+             pool=None, leases=None, bwlimit=None):
+    # Steps for one leg of a profile's sync, as endpoints() gives them.
+    # Sends go into a snapshot, or fan out to mirrors, or carry out a plan
+    # from plans, or send what the index found changed, or go in parallel
+    # streams, as the profile says (the first of those that applies);
+    # anything else is a regular run, retried as the profile says. health
+    # and resumption are filled in as by fanoutsteps() and
+    # resilientsteps(); pool and leases are as for connectsteps(). bwlimit
+    # (KiB/s) is shared among any rsyncs running at once. Returns (exit
+    # status, snapshots to prune).
+    direction, source, destination = leg
+    recursive = profile["flags"]["recursive"][1]
+    sending = direction == "send"
+    # For the steps running one rsync at a time
+    limited = _bwlimited(command, bwlimit)
+    if sending and profile["snapshots"]:
+        returncode, names = yield from snapshotsteps(limited, source,
+                                                     destination)
+        if returncode not in (0, VANISHED):
+            return returncode, []
+        # Vanished files don't make for an incomplete snapshot
+        return 0, expired(names, profile["snapshots"])
+    if sending and profile["mirrors"]:
+        rsh = None if pool is None else mirrorshell(profile, pool, leases)
+        return (yield from fanoutsteps(command, source, destination,
+                                       profile["mirrors"], health, rsh,
+                                       bwlimit)), []
+    plan = None
+    if sending and plans is not None:
+        plan = yield from cachedplansteps(limited, source, destination,
+                                          plans, recursive)
+    if plan is not None:
+        returncode = yield from listedsteps(limited, plan.files, source,
+                                            destination)
+    elif sending and profile["indexed"]:
+        returncode = yield from indexedsteps(
+            limited, source, destination, recursive, profile["hashing"],
+            bool(profile["choices"]["deletion"]))
+    elif sending and profile["streams"] > 1:
+        returncode = yield from shardedsteps(command, source, destination,
+                                             profile["streams"], recursive,
+                                             bwlimit)
+    else:
+        returncode = yield from resilientsteps(
+            limited + [source, destination], profile["retries"], resumption)
+    return returncode, []
+
+# --- Scheduling --- #
+
+class QueuedJob:
+    def __init__(self, profile):
+        self.profile = profile
+        self.name = profile.get("name") or profile["localpath"]
+        self.pair = syncpair(profile)
+        self.host = profile["remotehost"]
+        self.state = "pending"
+        self.started = None
+        self.finished = None
+        self.returncode = None
+        self.bwlimit = None
+        self.job = None
+        self.lasterror = ""
+        self.metrics = {}  # of the runs in progress, by tag
+        self.health = {}  # of its mirrors, see fanoutsteps()
+        self.resumption = {}  # see resilientsteps()
+        self.leases = []  # of ssh masters, see connectsteps()
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.monotonic()) - self.started
+
+class Scheduler:
+    # Runs queued profiles with a bounded number of concurrent jobs, a
+    # per-host limit, at most one job per pair (see syncpair()), and a
+    # global bandwidth budget (KiB/s, 0 for none)
+    # divided among them through --bwlimit, and again among each job's
+    # rsyncs running at once (see legsteps()). rsync can't change its limit
+    # while running, so shares are taken as each rsync starts: a job's
+    # second leg (sync mode "both"), or a newly started job, gets the share
+    # as rebalanced since. Shares assume the pool's about to be full, so
+    # the budget holds as jobs start.
+    # output, if given, is called with (queued job, stream, text) for
+    # everything jobs write (queued job None for background pruning). Every
+    # run's metrics go to the history. Profiles reusing connections go
+    # through masters in pool, an SSHPool, if given.
+    def __init__(self, workers=4, perhost=2, bandwidth=0, output=None,
+                 pool=None):
+        self.workers = workers
+        self.perhost = perhost
+        self.bandwidth = bandwidth
+        self.output = output
+        self.pool = pool
+        self.pending = deque()
+        self.running = []
+        self.finished = []
+        self.background = []  # RsyncJobs pruning snapshots
+
+    def add(self, profile):
+        queued = QueuedJob(profile)
+        self.pending.append(queued)
+        return queued
+
+    @property
+    def jobs(self):
+        return list(self.finished) + self.running + list(self.pending)
+
+    def busy(self, pair):
+        # Whether a running job syncs pair (see syncpair())
+        return any(queued.pair == pair for queued in self.running)
+
+    def share(self):
+        if not self.bandwidth:
+            return None
+        jobs = min(self.workers, len(self.running) + len(self.pending))
+        return max(self.bandwidth // max(jobs, 1), 1)
+
+    def _steps(self, queued):
+        checksnapshots(queued.profile)
+        command = yield from commandsteps(queued.profile, self.pool,
+                                          queued.leases)
+        for leg in endpoints(queued.profile):
+            queued.bwlimit = self.share()
+            returncode, names = yield from legsteps(
+                queued.profile, command, leg, queued.health,
+                queued.resumption, pool=self.pool, leases=queued.leases,
+                bwlimit=queued.bwlimit)
+            if names:
+                # In the background: the job's done, and needn't wait
+                self.background.append(RsyncJob(prunesteps(
+                    command, leg[2], names)).start())
+            if returncode:
+                return returncode
+
+    def tick(self):
+        # Call periodically, from one thread (e.g. Tk's after())
+        for job in list(self.background):
+            for _, stream, data in job.poll():
+                if stream == "stderr" and self.output is not None:
+                    self.output(None, stream, data)
+            if job.done:
+                self.background.remove(job)
+        for queued in list(self.running):
+            for tag, stream, data in queued.job.poll():
+                if stream == "record":
+                    queued.metrics[tag] = RunMetrics(*data)
+                elif stream == "exit" and tag in queued.metrics:
+                    recordrun(queued.metrics.pop(tag).finish(data))
+                if stream not in ("stdout", "stderr"):
+                    continue
+                if stream == "stdout" and tag in queued.metrics:
+                    queued.metrics[tag].feed(data)
+                if stream == "stderr":
+                    queued.lasterror = (queued.lasterror + data)[-200:]
+                if self.output is not None:
+                    self.output(queued, stream, data)
+            if queued.job.done:
+                for lease in queued.leases:
+                    self.pool.release(*lease)
+                queued.leases.clear()
+                self.running.remove(queued)
+                queued.finished = time.monotonic()
+                queued.returncode = queued.job.returncode
+                if queued.job.error is not None:
+                    queued.lasterror = str(queued.job.error)
+                queued.state = "cancelled" if queued.job.cancelled \
+                               else "failed" if queued.returncode \
+                               else "done"
+                self.finished.append(queued)
+        hosts = Counter(queued.host for queued in self.running)
+        for queued in list(self.pending):
+            if len(self.running) >= self.workers:
+                break
+            if queued.host and hosts[queued.host] >= self.perhost:
+                continue
+            # Never two syncs of the same pair at once (e.g. a job queued
+            # twice): they'd fight over the destination and its manifest
+            if self.busy(queued.pair):
+                continue
+            self.pending.remove(queued)
+            queued.state = "running"
+            queued.started = time.monotonic()
+            self.running.append(queued)
+            hosts[queued.host] += 1
+            queued.job = RsyncJob(self._steps(queued)).start()
+
+    def cancel(self):
+        # Pending jobs are finished, as cancelled, right away
+        while self.pending:
+            queued = self.pending.popleft()
+            queued.state = "cancelled"
+            queued.returncode = INTERRUPTED
+            self.finished.append(queued)
+        for queued in self.running:
+            queued.job.cancel()
+
+# --- Command line interface --- #
+
+def loadprofile(name):
+    # A JSON file, or the name of a saved job. Missing settings default.
+    if os.path.exists(name):
+        with open(name) as f:
+            return completeprofile(json.load(f))
+    profile = next((job for job in loadjobs() if job.get("name") == name),
+                   None)
+    if profile is None:
+        raise LookupError("No such profile or saved job: {}".format(name))
+    return profile
+
+def checkssh(user, host, ssh=None, say=print):
+    # Exercises an SSHPool against a host: bringing up its master, health
+    # checks, a session through it, and eviction, which is to spare the
+    # master while leased and close it after. Returns whether all went as
+    # it should.
+    pool = SSHPool(ssh, idle=0)
+    ok = True
+    def check(what, outcome):
+        nonlocal ok
+        ok = ok and outcome
+        say("{}: {}".format(what, "ok" if outcome else "FAILED"))
+    try:
+        try:
+            pool.connect(user, host)
+        except (OSError, SubprocessError) as e:
+            check("bringing up the master ({})".format(e), False)
+            return False
+        check("master alive", pool.alive(user, host))
+        session = Popen(split(pool.rsh(user, host))
+                        + [userhost(user, host), "sleep 1"],
+                        stdin=DEVNULL)
+        pool.evict()
+        check("leased master spared by eviction", pool.alive(user, host))
+        check("session through it unharmed", session.wait() == 0)
+        pool.release(user, host)
+        pool.evict()
+        check("idle master evicted", not pool.alive(user, host))
+        pool.connect(user, host)
+        check("master brought up again", pool.alive(user, host))
+        pool.release(user, host)
+        rsh = split(pool.rsh(user, host))
+    finally:
+        pool.close()
+    check("masters closed", run(rsh + ["-O", "check", userhost(user, host)],
+                                stdin=DEVNULL, stdout=DEVNULL,
+                                stderr=DEVNULL).returncode != 0)
+    return ok
+
+def _echo(queued, stream, text):
+    stream = sys.stdout if stream == "stdout" else sys.stderr
+    stream.write(text)
+    stream.flush()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="tkrsync-cli",
+                                     description="Run tkrsync profiles"
+                                                 " without the GUI.")
+    actions = parser.add_subparsers(dest="action", required=True)
+    action = actions.add_parser("run", help="run profiles")
+    action.add_argument("profiles", nargs="+", metavar="PROFILE",
+                        help="JSON file, or saved job name")
+    action.add_argument("--jobs", type=int, default=1,
+                        help="how many to run at once")
+    action.add_argument("--per-host", type=int, default=1)
+    action.add_argument("--bwlimit", type=int, default=0,
+                        help="total bandwidth budget, KiB/s")
+    action.add_argument("--textfile", metavar="PATH",
+                        help="export run metrics there afterwards, for"
+                             " Prometheus")
+    action.add_argument("--ssh", metavar="COMMAND",
+                        help="ssh command, e.g. a stand-in such as"
+                             " tkrsync-localssh (default: $TKRSYNC_SSH,"
+                             " or ssh)")
+    action = actions.add_parser("command", help="show the rsync commands"
+                                                " profiles run")
+    action.add_argument("profiles", nargs="+", metavar="PROFILE")
+    actions.add_parser("list", help="list saved jobs")
+    action = actions.add_parser("check-ssh", help="check reusing ssh"
+                                                  " connections to a host")
+    action.add_argument("host", metavar="[USER@]HOST")
+    action.add_argument("--ssh", metavar="COMMAND")
+    action = actions.add_parser("history", help="export run metrics")
+    action.add_argument("--format", choices=["jsonl", "prometheus"],
+                        default="jsonl")
+    action.add_argument("--days", type=float,
+                        help="only runs from the last DAYS days")
+    action.add_argument("--output", metavar="PATH",
+                        help="write there (atomically) rather than to"
+                             " standard output")
+    args = parser.parse_args(argv)
+
+    if args.action == "list":
+        for job in loadjobs():
+            print(job.get("name", ""))
+        return 0
+    if args.action == "check-ssh":
+        user, _, host = args.host.rpartition("@")
+        return 0 if checkssh(user, host,
+                             split(args.ssh) if args.ssh else None) else 1
+    if args.action == "history":
+        since = time.time() - args.days * 86400 if args.days else 0
+        if args.output:
+            exporthistory(args.output, args.format, since)
+        elif args.format == "prometheus":
+            sys.stdout.write(prometheus(loadhistory(since)))
+        else:
+            for metrics in loadhistory(since):
+                print(json.dumps(metrics))
+        return 0
+    try:
+        profiles = [loadprofile(name) for name in args.profiles]
+    except (LookupError, OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.action == "command":
+        for profile in profiles:
+            try:
+                capabilities = probeends(profile)
+            except (OSError, ValueError, SubprocessError):
+                capabilities = None
+            for _, source, destination in endpoints(profile):
+                print(" ".join(map(quote, buildcommand(profile, capabilities)
+                                          + [source, destination])))
+        return 0
+
+    scheduler = Scheduler(max(args.jobs, 1), max(args.per_host, 1),
+                          args.bwlimit, output=_echo,
+                          pool=SSHPool(split(args.ssh) if args.ssh
+                                       else None))
+    for profile in profiles:
+        scheduler.add(profile)
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *_: scheduler.cancel())
+    while scheduler.pending or scheduler.running or scheduler.background:
+        scheduler.tick()
+        time.sleep(_CLI_INTERVAL)
+    for queued in scheduler.finished:
+        if queued.job is not None and queued.job.error is not None:
+            print("{}: {}".format(queued.name, queued.job.error),
+                  file=sys.stderr)
+        if queued.resumption.get("attempts", 0) > 1:
+            print("{}: {} attempts, {} resumed rather than resent"
+                  .format(queued.name, queued.resumption["attempts"],
+                          human(queued.resumption["resumed"])),
+                  file=sys.stderr)
+    if args.textfile:
+        exporthistory(args.textfile, "prometheus")
+    # Non-zero if any job failed or was cancelled
+    return next((queued.returncode for queued in scheduler.finished
+                 if queued.returncode), 0)
+
+_CLI_INTERVAL = 0.05  # s
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,14 +2,21 @@
 
 import tkinter as tk
 from tkinter import ttk
-from tkinter.filedialog import askdirectory
+from tkinter.filedialog import askdirectory, asksaveasfilename
+from tkinter import messagebox
+from tkinter.simpledialog import askstring
 
-from collections import namedtuple, OrderedDict
-from subprocess import check_output, SubprocessError
+import queue
+import threading
+
+from collections import namedtuple
+from subprocess import SubprocessError
 from textwrap import indent
-from itertools import count
+from itertools import count, islice
 from getpass import getuser
 
+import rsynccore as core
+
 # TODO: remote host validation, and feedback by colouring the background of the entry field
 #from socket import gethostbyname
 
@@ -35,6 +42,107 @@ def _set_factory(target, next_callback=None):
             next_callback()
     return callback
 
+# How often the Tk thread drains output from running transfers; progress
+# widgets are redrawn at a fixed rate of their own.
+_POLL_INTERVAL = 50  # ms
+_FRAME_INTERVAL = 100  # ms
+_EVICT_INTERVAL = 60000  # ms
+_QUEUE_INTERVAL = 100  # ms
+_WATCH_INTERVAL = 250  # ms
+_SEARCH_INTERVAL = 100  # ms
+_LOG_WIDGET_LINES = 5000
+_SEARCH_LIMIT = 10000  # matches shown
+
+class QueueWindow(tk.Toplevel):
+    # View of the GUI's Scheduler: its settings, and its jobs with their
+    # states and durations. The GUI runs the scheduler, so closing the
+    # window leaves queued jobs running.
+    _INTERVAL = 500  # ms
+
+    def __init__(self, master, gui):
+        super().__init__(master)
+        self.title("Job queue")
+        self.gui = gui
+        self.scheduler = gui.scheduler
+
+        f = ttk.Frame(self)
+        f.grid(row=0, column=0, sticky=(tk.W, tk.E))
+        self.workers = tk.IntVar(value=self.scheduler.workers)
+        self.perhost = tk.IntVar(value=self.scheduler.perhost)
+        self.bandwidth = tk.IntVar(value=self.scheduler.bandwidth)
+        for column, (text, variable, to) in \
+            enumerate([("Concurrent jobs:", self.workers, 64),
+                       ("per host:", self.perhost, 64),
+                       ("Bandwidth budget (KiB/s, 0 for none):",
+                        self.bandwidth, 1 << 30)]):
+            ttk.Label(f, text=text).grid(row=0, column=2 * column,
+                                         sticky=tk.W)
+            ttk.Spinbox(f, from_=0 if variable is self.bandwidth else 1,
+                        to=to, width=8,
+                        textvariable=variable).grid(row=0,
+                                                    column=2 * column + 1,
+                                                    sticky=tk.W)
+
+        self.tree = ttk.Treeview(self, columns=("host", "state", "duration"))
+        self.tree.heading("#0", text="Job")
+        for column in ["host", "state", "duration"]:
+            self.tree.heading(column, text=column.capitalize())
+        self.tree.grid(row=1, column=0, sticky=(tk.N, tk.S, tk.W, tk.E))
+
+        f = ttk.Frame(self)
+        f.grid(row=2, column=0, sticky=tk.E)
+        for column, (text, command) in \
+            enumerate([("Add current settings…", self.addcurrent),
+                       ("Queue saved jobs", self.addsaved),
+                       ("Clear finished", self.clearfinished),
+                       ("Cancel all", self.scheduler.cancel)]):
+            ttk.Button(f, text=text, command=command).grid(row=0,
+                                                           column=column)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.pending = self.after(self._INTERVAL, self._tick)
+
+    def close(self):
+        self.after_cancel(self.pending)
+        self.gui.queuewindow = None
+        self.destroy()
+
+    def addcurrent(self):
+        name = askstring("Job name", "Save current settings as job:",
+                         parent=self)
+        if not name:
+            return
+        profile = self.gui.profile()
+        profile["name"] = name
+        jobs = [job for job in core.loadjobs() if job.get("name") != name]
+        core.savejobs(jobs + [profile])
+        self.scheduler.add(profile)
+
+    def addsaved(self):
+        for profile in core.loadjobs():
+            self.scheduler.add(profile)
+
+    def clearfinished(self):
+        self.scheduler.finished.clear()
+
+    def _tick(self):
+        try:
+            self.scheduler.workers = max(self.workers.get(), 1)
+            self.scheduler.perhost = max(self.perhost.get(), 1)
+            self.scheduler.bandwidth = max(self.bandwidth.get(), 0)
+        except tk.TclError:
+            pass  # mid-edit
+        self.tree.delete(*self.tree.get_children())
+        for queued in self.scheduler.jobs:
+            state = queued.state
+            if queued.state == "running" and queued.bwlimit:
+                state += " ({} KiB/s)".format(queued.bwlimit)
+            elif queued.state == "failed":
+                state += " ({})".format(queued.returncode)
+            self.tree.insert("", tk.END, text=queued.name,
+                             values=(queued.host or "(local)", state,
+                                     core.duration(queued.duration)))
+        self.pending = self.after(self._INTERVAL, self._tick)
+
 class RsyncTkGUI(ttk.Frame):
     def __init__(self, master):
         super().__init__(master)
@@ -81,6 +189,13 @@ class RsyncTkGUI(ttk.Frame):
         ttk.Entry(self, textvariable=self.remotehost).grid(row=row, column=1,
                                                            sticky=(tk.W, tk.E))
 
+        row = next(rows)
+        self.multiplex = tk.BooleanVar(value=True)
+        ttk.Checkbutton(self, text="Reuse SSH connections between syncs",
+                        onvalue=True, offvalue=False,
+                        variable=self.multiplex).grid(row=row, column=1,
+                                                      sticky=tk.W)
+
         row = next(rows)
         self.remotedirectory = tk.StringVar()
         ttk.Label(self, text="directory:").grid(row=row, column=0,
@@ -88,6 +203,23 @@ class RsyncTkGUI(ttk.Frame):
         entry = ttk.Entry(self, textvariable=self.remotedirectory)
         entry.grid(row=row, column=1, sticky=(tk.W, tk.E))
 
+        # Fan-out: sends go to the remote above, then are replayed on these
+        row = next(rows)
+        self.mirrors = []
+        self.health = {}
+        ttk.Label(self, text="mirrors:").grid(row=row, column=0,
+                                              sticky=(tk.N, tk.W))
+        f = ttk.Frame(self)
+        f.grid(row=row, column=1, sticky=(tk.W, tk.E))
+        self.mirrorlist = tk.Listbox(f, height=3, width=40)
+        self.mirrorlist.grid(row=0, column=0, rowspan=2, sticky=(tk.W, tk.E))
+        ttk.Button(f, text="Add remote above",
+                   command=self.addmirror).grid(row=0, column=1,
+                                                sticky=(tk.W, tk.E))
+        ttk.Button(f, text="Remove",
+                   command=self.removemirror).grid(row=1, column=1,
+                                                   sticky=(tk.W, tk.E))
+
         row = next(rows)
         self.syncmode = tk.StringVar()
         ttk.Label(self, text="Sync mode:").grid(row=row, column=0, sticky=tk.W)
@@ -103,6 +235,45 @@ class RsyncTkGUI(ttk.Frame):
             rb.grid(row=0, column=column, sticky=tk.E)
         rb.invoke()  # mode "both"
 
+        row = next(rows)
+        self.streams = tk.IntVar(value=1)
+        ttk.Label(self, text="Parallel streams:").grid(row=row, column=0,
+                                                       sticky=tk.W)
+        # Only applies to sending, as only the local tree can be sharded
+        ttk.Spinbox(self, from_=1, to=32, width=4,
+                    textvariable=self.streams).grid(row=row, column=1,
+                                                    sticky=tk.W)
+
+        row = next(rows)
+        self.watching = tk.BooleanVar()
+        self.debounce = tk.DoubleVar(value=2.0)
+        f = ttk.Frame(self)
+        f.grid(row=row, column=1, sticky=tk.W)
+        ttk.Checkbutton(f, text="Keep in sync (send only), after changes"
+                                " settle for",
+                        onvalue=True, offvalue=False, variable=self.watching,
+                        command=self.watch).grid(row=0, column=0, sticky=tk.W)
+        ttk.Spinbox(f, from_=0.1, to=600, increment=0.5, width=5,
+                    textvariable=self.debounce).grid(row=0, column=1,
+                                                     sticky=tk.W)
+        ttk.Label(f, text="s").grid(row=0, column=2, sticky=tk.W)
+
+        row = next(rows)
+        self.indexed = tk.BooleanVar()
+        self.hashing = tk.BooleanVar()
+        f = ttk.Frame(self)
+        f.grid(row=row, column=1, sticky=tk.W)
+        # Also only for sending
+        ttk.Checkbutton(f, text="Track local changes in an index",
+                        onvalue=True, offvalue=False,
+                        variable=self.indexed).grid(row=0, column=0,
+                                                    sticky=tk.W)
+        ttk.Checkbutton(f, text="…ignoring files touched but unmodified"
+                                " (hashes them)",
+                        onvalue=True, offvalue=False,
+                        variable=self.hashing).grid(row=0, column=1,
+                                                    sticky=tk.W)
+
         # --- Copy options --- #
         row = next(rows)
         nb = ttk.Notebook(self)
@@ -115,128 +286,7 @@ class RsyncTkGUI(ttk.Frame):
         subrows = count()
         for subrow, (groupname, group) in \
             zip(subrows,
-                [("Attributes to preserve",
-                  [("Permissions",                    "--perms",      "perms"),
-                   ("Modification times",             "--times",      "mtimes"),
-                   # -O, --omit-dir-times        omit directories from --times
-                   # -J, --omit-link-times       omit symlinks from --times
-                   ("Owning user",                    "--owner",      "owner"),
-                   ("Owning group",                   "--group",      "group"),
-                   ("Extended ACLs",                  "--acls",       "xacls"),
-                   ("Extended attributes",            "--xattrs",     "xattrs")]),
-
-                 # -L, --copy-links            transform symlink into referent file/dir
-                 #     --copy-unsafe-links     only "unsafe" symlinks are transformed
-                 #     --safe-links            ignore symlinks that point outside the tree
-                 #     --munge-links           munge symlinks to make them safer
-                 # -k, --copy-dirlinks         transform symlink to dir into referent dir
-                 # -K, --keep-dirlinks         treat symlinked dir on receiver as dir
-                 # -H, --hard-links            preserve hard links
-                 #("Link handling",
-                 # []),
-
-                 #     --inplace               update destination files in-place
-                 #     --append                append data onto shorter files
-                 #     --append-verify         --append w/old data in file checksum
-                 #("Update mode",
-                 # []),
-
-                 # -S, --sparse                handle sparse files efficiently
-                 #     --preallocate           allocate dest files before writing
-                 # -W, --whole-file            copy files whole (w/o delta-xfer algorithm)
-                 # -B, --block-size=SIZE       force a fixed checksum block-size
-                 # -z, --compress              compress file data during the transfer
-                 # TODO: Use [ttk.Scale widget](http://www.tkdocs.com/tutorial/morewidgets.html#scale) here.
-                 #     --compress-level=NUM    explicitly set compression level
-                 #     --skip-compress=LIST    skip compressing files with suffix in LIST
-                 #("Performance",
-                 # []),
-
-                 # Required for syncmode == "both"
-                 # -u, --update                skip files that are newer on the receiver
-
-                 # -c, --checksum              skip based on checksum, not mod-time & size
-                 # -y, --fuzzy                 find similar file for basis if no dest file
-                 # -I, --ignore-times          don't skip files that match size and time
-                 #     --modify-window=NUM     compare mod-times with reduced accuracy
-                 #     --size-only             skip files that match in size
-                 #     --existing              skip creating new files on receiver
-                 #     --ignore-existing       skip updating files that exist on receiver
-                 #     --remove-source-files   sender removes synchronized files (non-dir)
-                 #     --force                 force deletion of dirs even if not empty
-                 # -m, --prune-empty-dirs      prune empty directory chains from file-list
-                 #("Difference detection and resolution",
-                 # []),
-
-                 #     --numeric-ids           don't map uid/gid values by user/group name
-                 #     --usermap=STRING        custom username mapping
-                 #     --groupmap=STRING       custom groupname mapping
-                 #     --chown=USER:GROUP      simple username/groupname mapping
-                 #("Remote end file ownership",
-                 # []),
-
-                 #     --partial               keep partially transferred files
-                 #     --partial-dir=DIR       put a partially transferred file into DIR
-
-                 #     --timeout=SECONDS       set I/O timeout in seconds
-                 #     --contimeout=SECONDS    set daemon connection timeout in seconds
-                 #     --port=PORT             specify double-colon alternate port number
-                 # -4, --ipv4                  prefer IPv4
-                 # -6, --ipv6                  prefer IPv6
-                 #("Network",
-                 # []),
-
-                 #     --link-dest=DIR         hardlink to files in DIR when unchanged
-                 # -b, --backup                make backups (see --suffix & --backup-dir)
-                 #     --backup-dir=DIR        make backups into hierarchy based in DIR
-                 #     --suffix=SUFFIX         backup suffix (default ~ w/o --backup-dir)
-                 #     --delay-updates         put all updated files into place at end
-                 #("'Backup'",
-                 # []),
-
-                 #     --stats                 give some file-transfer stats
-                 # -8, --8-bit-output          leave high-bit chars unescaped in output
-                 # -h, --human-readable        output numbers in a human-readable format
-                 # -i, --itemize-changes       output a change-summary for all updates
-                 #     --log-file=FILE         log what we're doing to the specified FILE
-                 # TODO: Show [indeterminate # progress](http://www.tkdocs.com/tutorial/morewidgets.html#progressbar)
-                 #       if this is unset. Else, this'll show up in the redirected
-                 #       standard output.
-                 #     --progress              show progress during transfer
-                 #("Reporting",
-                 # []),
-
-                 # -x, --one-file-system       don't cross filesystem boundaries
-                 #     --max-delete=NUM        don't delete more than NUM files
-                 #     --max-size=SIZE         don't transfer any file larger than SIZE
-                 #     --min-size=SIZE         don't transfer any file smaller than SIZE
-
-                 # -C, --cvs-exclude           auto-ignore files in the same way CVS does
-                 # -f, --filter=RULE           add a file-filtering RULE
-                 #     --exclude=PATTERN       exclude files matching PATTERN
-                 #     --exclude-from=FILE     read exclude patterns from FILE
-                 #     --include=PATTERN       don't exclude files matching PATTERN
-                 #     --include-from=FILE     read include patterns from FILE
-                 #     --files-from=FILE       read list of source-file names from FILE
-
-                 #     --bwlimit=RATE          limit socket I/O bandwidth
-                 #("Throttling and filtering",
-                 # []),
-
-                 # Assorted:
-                 #     --ignore-errors         delete even if there are I/O errors
-                 # -n, --dry-run               perform a trial run with no changes made
-                 #     --list-only             list the files instead of copying them
-                 # -T, --temp-dir=DIR          create temporary files in directory DIR
-                 #     --compare-dest=DIR      also compare received files relative to DIR
-                 #     --copy-dest=DIR         ... and include copies of unchanged files
-
-                 ("Additional file types to preserve",
-                  [("Directories",                    "--dirs",       "directories"),
-                   ("Symbolic links",                 "--links",      "slinks"),
-                   ("Hard links",                     "--hard-links", "hlinks"),
-                   ("Special files",                  "--specials",   "specials"),
-                   ("Device files (super-user only)", "--devices",    "devices")])]):
+                core.FLAGGROUPS):
             subframe = ttk.Labelframe(advanced, text=groupname)
             subframe.grid(row=subrow, column=0, columnspan=2,
                           sticky=tk.W)
@@ -252,16 +302,169 @@ class RsyncTkGUI(ttk.Frame):
                 checkbutton.grid(row=subsubrow, column=0, columnspan=2,
                                  sticky=(tk.W, tk.E))
 
+        subframe = ttk.Labelframe(advanced, text="Snapshots")
+        self.snapshots = tk.BooleanVar()
+        ttk.Checkbutton(subframe, text="Send into a new timestamped"
+                                       " directory each time, hard-linking"
+                                       " unchanged files to the last one",
+                        onvalue=True, offvalue=False,
+                        variable=self.snapshots).grid(row=0, column=0,
+                                                      columnspan=6,
+                                                      sticky=tk.W)
+        self.retention = {}
+        for column, (period, keep) in enumerate(core.RETENTION.items()):
+            self.retention[period] = tk.IntVar(value=keep)
+            ttk.Label(subframe, text="Keep {}:".format(period)).grid(
+                row=1, column=2 * column, sticky=tk.W)
+            ttk.Spinbox(subframe, from_=0, to=1000, width=4,
+                        textvariable=self.retention[period]).grid(
+                            row=1, column=2 * column + 1, sticky=tk.W)
+        subframe.grid(row=next(subrows), column=0, columnspan=2,
+                      sticky=(tk.W, tk.E))
+
+        subframe = ttk.Labelframe(advanced, text="Network")
+        subsubrows = count()
+        for subsubrow, (description, flag, key) in \
+            zip(subsubrows, core.NETWORKFLAGS):
+            rf = _rf(tk.BooleanVar(), flag, _dirty_factory())
+            self.flags[key] = rf
+            ttk.Checkbutton(subframe, text=description, variable=rf.variable,
+                            onvalue=True, offvalue=False,
+                            command=_set_factory(rf.dirty)).grid(row=subsubrow,
+                                                                 column=0,
+                                                                 columnspan=2,
+                                                                 sticky=tk.W)
+        subsubrow = next(subsubrows)
+        ttk.Label(subframe, text="I/O timeout (s, 0 for none):").grid(
+            row=subsubrow, column=0, sticky=tk.W)
+        timeout = tk.IntVar(value=0)
+        rc = _rc(tk.StringVar(), _dirty_factory())
+        self.choices["timeout"] = rc
+        def callback(*_, rc=rc):
+            try:
+                seconds = timeout.get()
+            except tk.TclError:
+                # Mid-edit
+                return
+            rc.variable.set("--timeout={}".format(seconds) if seconds > 0
+                            else "")
+            rc.dirty(True)
+        timeout.trace_add("write", callback)
+        ttk.Spinbox(subframe, from_=0, to=3600, increment=30, width=6,
+                    textvariable=timeout).grid(row=subsubrow, column=1,
+                                               sticky=tk.W)
+        subsubrow = next(subsubrows)
+        # Retries resume, so they get a partial-dir and a timeout regardless
+        ttk.Label(subframe, text="Retry dropped transfers:").grid(
+            row=subsubrow, column=0, sticky=tk.W)
+        self.retries = tk.IntVar(value=0)
+        ttk.Spinbox(subframe, from_=0, to=100, width=6,
+                    textvariable=self.retries).grid(row=subsubrow, column=1,
+                                                    sticky=tk.W)
+        subframe.grid(row=next(subrows), column=0, columnspan=2,
+                      sticky=(tk.W, tk.E))
+
+        subframe = ttk.Labelframe(advanced, text="Performance")
+        subsubrows = count()
+        for subsubrow, (description, flag, key) in \
+            zip(subsubrows, core.PERFORMANCEFLAGS):
+            rf = _rf(tk.BooleanVar(), flag, _dirty_factory())
+            self.flags[key] = rf
+            ttk.Checkbutton(subframe, text=description, variable=rf.variable,
+                            onvalue=True, offvalue=False,
+                            command=_set_factory(rf.dirty)).grid(row=subsubrow,
+                                                                 column=0,
+                                                                 columnspan=2,
+                                                                 sticky=tk.W)
+        # Compression level and skipped suffixes only mean anything with
+        # compression on.
+        compresswidgets = []
+        level = tk.IntVar(value=6)
+        def callback(*_):
+            enabled = self.flags["compress"].variable.get()
+            for widget in compresswidgets:
+                widget["state"] = (tk.NORMAL if enabled else tk.DISABLED,)
+            self.choices["compresslevel"].variable.set(
+                "--compress-level={}".format(level.get()) if enabled else "")
+            suffixes = skipcompress.get().strip()
+            self.choices["skipcompress"].variable.set(
+                "--skip-compress=" + suffixes if enabled and suffixes else "")
+        rf = _rf(tk.BooleanVar(), core.FLAGS["compress"], _dirty_factory())
+        self.flags["compress"] = rf
+        rf.variable.trace_add("write", callback)
+        ttk.Checkbutton(subframe, text="Compress file data during transfer",
+                        variable=rf.variable, onvalue=True, offvalue=False,
+                        command=_set_factory(rf.dirty)).grid(
+                            row=next(subsubrows), column=0, columnspan=2,
+                            sticky=tk.W)
+        subsubrow = next(subsubrows)
+        label = ttk.Label(subframe, text="Compression level:")
+        label.grid(row=subsubrow, column=0, sticky=tk.W)
+        compresswidgets.append(label)
+        levellabel = ttk.Label(subframe, width=2, textvariable=level)
+        levellabel.grid(row=subsubrow, column=2, sticky=tk.W)
+        compresswidgets.append(levellabel)
+        rc = _rc(tk.StringVar(), _dirty_factory())
+        self.choices["compresslevel"] = rc
+        def setlevel(value, rc=rc):
+            # Scales are continuous; levels aren't
+            level.set(round(float(value)))
+            rc.dirty(True)
+        scale = ttk.Scale(subframe, orient=tk.HORIZONTAL, from_=1, to=9,
+                          length=120, variable=level, command=setlevel)
+        scale.grid(row=subsubrow, column=1, sticky=(tk.W, tk.E))
+        compresswidgets.append(scale)
+        level.trace_add("write", callback)
+        self.compresslevel = level
+        subsubrow = next(subsubrows)
+        label = ttk.Label(subframe, text="Don't compress suffixes:")
+        label.grid(row=subsubrow, column=0, sticky=tk.W)
+        compresswidgets.append(label)
+        skipcompress = tk.StringVar()
+        rc = _rc(tk.StringVar(), _dirty_factory())
+        self.choices["skipcompress"] = rc
+        skipcompress.trace_add("write", callback)
+        entry = ttk.Entry(subframe, textvariable=skipcompress)
+        entry.grid(row=subsubrow, column=1, columnspan=2, sticky=(tk.W, tk.E))
+        compresswidgets.append(entry)
+        callback()
+
+        subsubrow = next(subsubrows)
+        ttk.Label(subframe, text="Checksum block size:").grid(row=subsubrow,
+                                                             column=0,
+                                                             sticky=tk.W)
+        blocksize = tk.StringVar()
+        rc = _rc(tk.StringVar(), _dirty_factory())
+        self.choices["blocksize"] = rc
+        def callback(*_, rc=rc):
+            value = blocksize.get().strip()
+            rc.variable.set("--block-size=" + value if value else "")
+            rc.dirty(True)
+        blocksize.trace_add("write", callback)
+        ttk.Entry(subframe, textvariable=blocksize, width=8).grid(
+            row=subsubrow, column=1, sticky=tk.W)
+
+        self.autotunebutton = ttk.Button(subframe, text="Auto-tune",
+                                         command=self.autotune)
+        self.autotunebutton.grid(row=next(subsubrows), column=0, columnspan=3,
+                                 sticky=tk.W)
+        subframe.grid(row=next(subrows), column=0, columnspan=2,
+                      sticky=(tk.W, tk.E))
+
         subframe = ttk.Labelframe(advanced, text="Deletion")
         subsubrows = count()
         # --delete-* should only be available if --delete is set
-        choice = tk.StringVar()
+        choice = tk.StringVar(value="--delete-before")
         variable = tk.BooleanVar()
         widgets = []
-        def callback(widgets=widgets, variable=variable):
+        rc = _rc(tk.StringVar(), _dirty_factory())
+        self.choices["deletion"] = rc
+        def callback(*_, widgets=widgets, variable=variable, rc=rc):
             statespec = (tk.NORMAL if variable.get() else tk.DISABLED,)
             for widget in widgets:
                 widget["state"] = statespec
+            rc.variable.set(choice.get() if variable.get() else "")
+        choice.trace_add("write", callback)
         checkbutton = ttk.Checkbutton(subframe, variable=variable,
                                       onvalue=True, offvalue=False,
                                       text="Delete extraneous files from"
@@ -282,7 +485,7 @@ class RsyncTkGUI(ttk.Frame):
                               state=(tk.DISABLED,))
             label.grid(row=subsubrow, column=0, sticky=tk.W)
             widgets.append(label)
-            button = ttk.Radiobutton(subframe, variable=variable, value=flag,
+            button = ttk.Radiobutton(subframe, variable=choice, value=flag,
                                      # FIXME: unavoidable duplication of work?
                                      state=(tk.DISABLED,))
             button.grid(row=subsubrow, column=1, sticky=(tk.W, tk.E))
@@ -291,8 +494,7 @@ class RsyncTkGUI(ttk.Frame):
                       sticky=(tk.W, tk.E))
 
         subframe = ttk.Labelframe(advanced, text="Difference detection and resolution")
-        rf = _rf(tk.BooleanVar(), "--update", _dirty_factory())
-        rf.variable.set(True)  # FIXME: duplication of effort
+        rf = _rf(tk.BooleanVar(), core.FLAGS["update"], _dirty_factory())
         self.flags["update"] = rf
         ttk.Checkbutton(subframe,
                         text="Skip files that are newer on the receiver",
@@ -340,21 +542,7 @@ class RsyncTkGUI(ttk.Frame):
         archive_mode = tk.BooleanVar()
         def callback():
             mode = archive_mode.get()
-            for flag in map(self.flags.__getitem__,
-                            [# As per rsync '-a' flag, minus recursion. Not
-                             # exactly the semantics of the original rsync,
-                             # but sensible to someone who hasn't used it.
-                             # Would they care, they'd use rsync directly
-                             # anyhow.
-                             "slinks", "perms", "mtimes",
-                             "group", "owner", "devices", "specials",
-                             # what users really should also care about,
-                             # despite not being included in '-a' set
-                             "xattrs", "xacls", "hlinks",
-                             # We separate the notion of 'archiving' from
-                             # recursing, but still copy directories themselves
-                             # (not their contents).
-                             "directories"]):
+            for flag in map(self.flags.__getitem__, core.ARCHIVEFLAGS):
                 flag.variable.set(mode)
         checkbutton = ttk.Checkbutton(simple,
                                       onvalue=True, offvalue=False,
@@ -366,7 +554,7 @@ class RsyncTkGUI(ttk.Frame):
         checkbutton.grid(row=next(subrows), column=0, columnspan=2)
 
         variable = tk.BooleanVar()
-        rf = _rf(variable, "--recursive", _dirty_factory())
+        rf = _rf(variable, core.FLAGS["recursive"], _dirty_factory())
         self.flags["recursive"] = rf
         def callback():
             # FIXME: closure name clash (clobbering) issues?
@@ -385,40 +573,573 @@ class RsyncTkGUI(ttk.Frame):
         nb.add(simple, text="Simple")
         nb.add(advanced, text="Advanced")
 
+        for key, value in core.DEFAULTS.items():
+            self.flags[key].variable.set(value)
+
         # TODO: Display command at bottom, as being built
 
         row = next(rows)
-        ttk.Button(self, text="Sync", command=self.sync).grid(row=row, column=1,
-                                                              sticky=tk.E)
+        f = ttk.Frame(self)
+        f.grid(row=row, column=1, sticky=tk.E)
+        self.planbutton = ttk.Button(f, text="Plan", command=self.plan)
+        self.planbutton.grid(row=0, column=0)
+        self.syncbutton = ttk.Button(f, text="Sync", command=self.sync)
+        self.syncbutton.grid(row=0, column=1)
+        self.pausebutton = ttk.Button(f, text="Pause", command=self.pause,
+                                      state=(tk.DISABLED,))
+        self.pausebutton.grid(row=0, column=2)
+        self.cancelbutton = ttk.Button(f, text="Cancel", command=self.cancel,
+                                       state=(tk.DISABLED,))
+        self.cancelbutton.grid(row=0, column=3)
+        ttk.Button(f, text="Queue…",
+                   command=self.showqueue).grid(row=0, column=4)
+        ttk.Button(f, text="rsync version…",
+                   command=self.showversion).grid(row=0, column=5)
+        ttk.Button(f, text="Export metrics…",
+                   command=self.exportmetrics).grid(row=0, column=6)
 
         row = next(rows)
         ttk.Separator(self, orient=tk.HORIZONTAL).grid(row=row, column=0,
                                                        columnspan=2,
                                                        sticky=(tk.W, tk.E))
 
+        row = next(rows)
+        self.status = tk.StringVar()
+        ttk.Label(self, textvariable=self.status).grid(row=row, column=0,
+                                                      columnspan=2,
+                                                      sticky=(tk.W, tk.E))
+
+        row = next(rows)
+        f = ttk.Frame(self)
+        f.grid(row=row, column=0, columnspan=2, sticky=(tk.W, tk.E))
+        self.progressbar = ttk.Progressbar(f, orient=tk.HORIZONTAL,
+                                           length=300, maximum=100)
+        self.progressbar.grid(row=0, column=0, columnspan=3,
+                              sticky=(tk.W, tk.E))
+        self.throughput = tk.StringVar()
+        self.filerate = tk.StringVar()
+        self.eta = tk.StringVar()
+        for column, variable in enumerate([self.throughput, self.filerate,
+                                           self.eta]):
+            ttk.Label(f, textvariable=variable).grid(row=1, column=column,
+                                                     sticky=tk.W)
+
+        row = next(rows)
+        f = ttk.Frame(self)
+        f.grid(row=row, column=0, columnspan=2, sticky=(tk.W, tk.E))
+        # The log shows the tail of a run's output, or what a search of all
+        # of it (as spilled to disk) finds.
+        subframe = ttk.Frame(f)
+        subframe.grid(row=0, column=0, columnspan=2, sticky=(tk.W, tk.E))
+        ttk.Label(subframe, text="Find:").grid(row=0, column=0, sticky=tk.W)
+        self.logsearch = tk.StringVar()
+        entry = ttk.Entry(subframe, textvariable=self.logsearch)
+        entry.grid(row=0, column=1, sticky=(tk.W, tk.E))
+        entry.bind("<Return>", lambda _: self.findlog())
+        self.logfilter = tk.StringVar(value="All")
+        ttk.Combobox(subframe, textvariable=self.logfilter, width=10,
+                     values=["All", "Errors", "Deletions"],
+                     state=("readonly",)).grid(row=0, column=2)
+        ttk.Button(subframe, text="Find",
+                   command=self.findlog).grid(row=0, column=3)
+        ttk.Button(subframe, text="Live",
+                   command=self.livelog).grid(row=0, column=4)
+        self.log = tk.Text(f, height=12, width=80, wrap=tk.NONE,
+                           state=(tk.DISABLED,))
+        self.log.grid(row=1, column=0, sticky=(tk.W, tk.E))
+        scrollbar = ttk.Scrollbar(f, orient=tk.VERTICAL,
+                                  command=self.log.yview)
+        scrollbar.grid(row=1, column=1, sticky=(tk.N, tk.S))
+        self.log["yscrollcommand"] = scrollbar.set
+        self.logbuffer = None
+        self.searching = None
+
+        self.job = None
+        self.outcome = None
+        self.recording = False
+        self.metrics = {}
+        self.plans = core.PlanCache()
+        self.planned = None
+        self.sshpool = core.SSHPool()
+        self.leases = []  # of ssh masters by the job, see connectsteps()
+        self.watcher = None
+        self.pendingbatch = None
+        self.scheduler = core.Scheduler(pool=self.sshpool)
+        self.queuewindow = None
+        self.after(_EVICT_INTERVAL, self._evict)
+        self.after(_QUEUE_INTERVAL, self._tickqueue)
+
 
     def showversion(self):
         try:
-            message = check_output(["rsync", "--version"])
-        except SubprocessError as e:
+            capabilities = core.probe()
+        except (OSError, ValueError, SubprocessError) as e:
             message = "Couldn't invoke rsync. Is it installed properly?\n\n" \
                       + indent(str(e), prefix="\t")
             dialog = messagebox.showerror
         else:
+            message = "rsync {version}, protocol {protocol}\n\n" \
+                      "Checksums: {checksums}\n" \
+                      "Compression: {compressions}\n" \
+                      "Overall progress: {progress2}\n" \
+                      "Incremental recursion: {increcurse}".format(
+                          version=capabilities["version"],
+                          protocol=capabilities["protocol"],
+                          checksums=" ".join(capabilities["checksums"]),
+                          compressions=" ".join(capabilities["compressions"]),
+                          progress2="yes" if capabilities["progress2"]
+                                    else "no",
+                          increcurse="yes" if capabilities["increcurse"]
+                                     else "no")
             dialog = messagebox.showinfo
-        finally:
-            # FIXME: Pass parent widget if possible?
-            dialog(message)
+        dialog(title="rsync version", message=message, parent=self)
+
+    def showqueue(self):
+        if self.queuewindow is None:
+            self.queuewindow = QueueWindow(self, self)
+        else:
+            self.queuewindow.lift()
+
+    def _tickqueue(self):
+        # Queued jobs are polled here, window or not: left unpolled, their
+        # output would fill up and stall them.
+        self.scheduler.tick()
+        self.after(_QUEUE_INTERVAL, self._tickqueue)
+
+    def exportmetrics(self):
+        path = asksaveasfilename(parent=self, title="Export run metrics",
+                                 defaultextension=".jsonl",
+                                 filetypes=[("JSON lines", ".jsonl"),
+                                            ("Prometheus textfile", ".prom")])
+        if not path:
+            return
+        try:
+            core.exporthistory(path, "prometheus" if path.endswith(".prom")
+                                     else "jsonl")
+        except OSError as e:
+            messagebox.showerror(title="Export run metrics", message=str(e),
+                                 parent=self)
+
+    def profile(self):
+        return {"flags": {key: [flag.flag, flag.variable.get()]
+                          for key, flag in self.flags.items()},
+                "choices": {key: choice.variable.get()
+                            for key, choice in self.choices.items()},
+                "localpath": self.localpath.get(),
+                "remoteuser": self.remoteuser.get(),
+                "remotehost": self.remotehost.get(),
+                "remotedirectory": self.remotedirectory.get(),
+                "syncmode": self.syncmode.get(),
+                "mirrors": [dict(mirror) for mirror in self.mirrors],
+                "snapshots": {period: keep.get()
+                              for period, keep in self.retention.items()}
+                             if self.snapshots.get() else None,
+                "retries": self.retries.get(),
+                "streams": self.streams.get(),
+                "indexed": self.indexed.get(),
+                "hashing": self.hashing.get(),
+                "multiplex": self.multiplex.get()}
+
+    def addmirror(self):
+        mirror = {"user": self.remoteuser.get(),
+                  "host": self.remotehost.get(),
+                  "directory": self.remotedirectory.get()}
+        if mirror["directory"] and mirror not in self.mirrors:
+            self.mirrors.append(mirror)
+            self._showmirrors()
+
+    def removemirror(self):
+        for index in sorted(self.mirrorlist.curselection(), reverse=True):
+            del self.mirrors[index]
+        self._showmirrors()
+
+    def _showmirrors(self):
+        self.mirrorlist.delete(0, tk.END)
+        for mirror in self.mirrors:
+            name = core.mirrordestination(mirror)
+            if name in self.health:
+                state, returncode = self.health[name]
+                name += " ({}{})".format(state, ", exit status {}"
+                                                .format(returncode)
+                                                if returncode else "")
+            self.mirrorlist.insert(tk.END, name)
 
     def rsynccommand(self):
-        return ["rsync"] \
-               + [flag.flag for flag in self.flags.values() \
-                  if flag.variable.get()] \
-               + [choice.variable.get() for choice in self.choices.values() \
-                  if choice.variable.get()]
+        return core.buildcommand(self.profile())
+
+    def endpoints(self):
+        return core.endpoints(self.profile())
+
+    def _prune(self, command, destination, names):
+        # In the background: the next run needn't wait for it
+        if not names:
+            return
+        job = core.RsyncJob(core.prunesteps(command, destination,
+                                            names)).start()
+        self.after(_POLL_INTERVAL, self._prunepoll, job, names)
+
+    def _prunepoll(self, job, names):
+        errors = "".join(data for _, stream, data in job.poll()
+                         if stream == "stderr")
+        if errors and self.logbuffer is not None:
+            self._log(errors)
+        if not job.done:
+            self.after(_POLL_INTERVAL, self._prunepoll, job, names)
+        elif job.returncode and self.logbuffer is not None:
+            self._log("Pruning snapshots {} failed (exit status {})\n"
+                      .format(", ".join(names), job.returncode))
+
+    def _evict(self):
+        threading.Thread(target=self.sshpool.evict, daemon=True).start()
+        self.after(_EVICT_INTERVAL, self._evict)
+
+    def _syncsteps(self):
+        profile = self.profile()
+        command = yield from core.commandsteps(profile, self.sshpool,
+                                               self.leases)
+        self.health = {}
+        for leg in core.endpoints(profile):
+            resumption = {}
+            returncode, names = yield from core.legsteps(
+                profile, command, leg, self.health, resumption, self.plans,
+                self.sshpool, self.leases)
+            self._prune(command, leg[2], names)
+            if resumption.get("attempts", 0) > 1:
+                self.outcome = "Done after {} attempts, {} resumed" \
+                               " rather than resent.".format(
+                                   resumption["attempts"],
+                                   core.human(resumption["resumed"]))
+            if returncode:
+                return returncode
+
+    def _plansteps(self):
+        profile = self.profile()
+        _, source, destination = core.endpoints(profile)[0]
+        command = yield from core.commandsteps(profile, self.sshpool,
+                                               self.leases)
+        returncode, self.planned = yield from core.plansteps(
+            command, source, destination, self.plans,
+            profile["flags"]["recursive"][1])
+        return returncode
+
+    def _autotunesteps(self):
+        profile = self.profile()
+        _, source, destination = core.endpoints(profile)[0]
+        # With compression, for the algorithm negotiated for it
+        compressing = dict(profile["flags"],
+                           compress=(core.FLAGS["compress"], True))
+        command = yield from core.commandsteps(
+            dict(profile, flags=compressing), self.sshpool, self.leases)
+        results = []
+        returncode, total = yield from core.autotunesteps(
+            command, source, destination, results,
+            profile["flags"]["recursive"][1])
+        if returncode:
+            return returncode
+        if not results:
+            self.outcome = "Nothing to calibrate with."
+            return 0
+
+        self._log("".join("{}: {:.2f}s wall, {:.2f}s CPU, {}/s\n"
+                          .format(name, wall, cpu, core.human(total / wall))
+                          for wall, cpu, name, _ in results))
+        _, _, name, flags = min(results)
+        self.flags["wholefile"].variable.set("--whole-file" in flags)
+        self.flags["compress"].variable.set("--compress" in flags)
+        for flag in flags:
+            if flag.startswith("--compress-level="):
+                self.compresslevel.set(int(flag.split("=")[1]))
+        self.outcome = "Auto-tuned: {}.".format(name)
+
+    def autotune(self):
+        if self.syncmode.get() == "receive":
+            self.status.set("Auto-tuning needs a local source"
+                            " (sync mode send or both).")
+            return
+        self._start(self._autotunesteps(), "Auto-tuning…")
+
+    def watch(self):
+        if not self.watching.get():
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher = None
+            self.pendingbatch = None
+            return
+        if self.syncmode.get() != "send":
+            self.watching.set(False)
+            self.status.set("Keeping in sync needs sync mode send.")
+            return
+        if self.snapshots.get() or self.mirrors:
+            # Batches of changes are neither snapshots nor sent to mirrors
+            self.watching.set(False)
+            self.status.set("Keeping in sync doesn't go with snapshots"
+                            " or mirrors.")
+            return
+        _, source, _ = self.endpoints()[0]
+        try:
+            self.watcher = core.Watcher(source, self.debounce.get()).start()
+        except (OSError, AttributeError) as e:
+            # AttributeError: no inotify in this libc
+            self.watching.set(False)
+            self.status.set("Can't watch {}: {}".format(source, e))
+            return
+        self.status.set("Watching {}…".format(source))
+        self.after(_WATCH_INTERVAL, self._watchpoll)
+
+    def _watchpoll(self):
+        watcher = self.watcher
+        if watcher is None:
+            return
+        # Batches arriving while a sync runs (ours, or a queued job's) are
+        # merged into one, run after it: never two syncs of the same pair at
+        # once.
+        try:
+            while True:
+                full, paths = watcher.batches.get_nowait()
+                if self.pendingbatch is None:
+                    self.pendingbatch = (full, paths)
+                else:
+                    self.pendingbatch = (self.pendingbatch[0] or full,
+                                         self.pendingbatch[1] | paths)
+        except queue.Empty:
+            pass
+        if self.pendingbatch is not None \
+           and (self.job is None or self.job.done) \
+           and not self.scheduler.busy(core.syncpair(self.profile())):
+            full, paths = self.pendingbatch
+            self.pendingbatch = None
+            self._start(self._watchsteps(watcher, full, paths),
+                        "Syncing changes…", record=True)
+        if watcher.error is not None:
+            self.status.set(watcher.error)
+        self.after(_WATCH_INTERVAL, self._watchpoll)
+
+    def _watchsteps(self, watcher, full, paths):
+        profile = self.profile()
+        leg = core.endpoints(profile)[0]
+        _, source, destination = leg
+        command = yield from core.commandsteps(profile, self.sshpool,
+                                               self.leases)
+        if full or profile["snapshots"] or profile["mirrors"]:
+            # As a sync would go: into a snapshot, or out to the mirrors
+            # (should those have been set up since watching started), ...
+            self.health = {}
+            returncode, names = yield from core.legsteps(
+                profile, command, leg, self.health, {}, self.plans,
+                self.sshpool, self.leases)
+            self._prune(command, destination, names)
+            return returncode
+        changed, deleted = yield core.Task(watcher.partition, paths)
+        returncode = yield from core.listedsteps(command, changed,
+                                                 source, destination)
+        # Deletions only as a regular run would make them
+        if not returncode and profile["choices"]["deletion"]:
+            returncode = yield from core.listedsteps(command, deleted,
+                                                     source, destination,
+                                                     deleting=True)
+        return returncode
+
+    def plan(self):
+        if self.syncmode.get() == "receive":
+            self.status.set("Planning needs a local source"
+                            " (sync mode send or both).")
+            return
+        self.planned = None
+        self._start(self._plansteps(), "Planning…")
 
     def sync(self):
-        raise NotImplementedError()
+        if self.snapshots.get() and self.syncmode.get() != "send":
+            self.status.set("Snapshots need sync mode send.")
+            return
+        self._start(self._syncsteps(), "Syncing…", record=True)
+
+    def _start(self, steps, status, record=False):
+        # record: whether the runs go to the metrics history (syncs, but
+        # not e.g. dry runs)
+        if self.job is not None and not self.job.done:
+            return
+        self.recording = record
+        self.metrics = {}
+        self.leases = []
+        if self.logbuffer is not None:
+            self.logbuffer.close()
+        self.logbuffer = core.LogBuffer(core.logpath())
+        self.searching = None
+        self._showlog([], replace=True)
+        self.outcome = None
+        self.job = core.RsyncJob(steps).start()
+        self.status.set(status)
+        self.planbutton["state"] = (tk.DISABLED,)
+        self.syncbutton["state"] = (tk.DISABLED,)
+        self.autotunebutton["state"] = (tk.DISABLED,)
+        self.pausebutton["state"] = (tk.NORMAL,)
+        self.cancelbutton["state"] = (tk.NORMAL,)
+        self.progress = {}
+        self.meter = core.ProgressMeter()
+        self.progressbar["value"] = 0
+        if self.flags["progress"].variable.get():
+            self.progressbar["mode"] = "determinate"
+        else:
+            self.progressbar["mode"] = "indeterminate"
+            self.progressbar.start()
+        self.after(_POLL_INTERVAL, self._poll)
+        self.after(_FRAME_INTERVAL, self._redraw)
+
+    def _poll(self):
+        # Coalesce everything drained this tick into a single insert; one
+        # Text.insert per chunk is what makes the UI crawl.
+        for tag, stream, data in self.job.poll():
+            if stream == "step":
+                self.progress = {}
+            elif stream == "start":
+                self.progress[tag] = core.ProgressParser()
+                self.logbuffer.write("$ {}\n".format(data), tag)
+            elif stream == "record":
+                if self.recording:
+                    self.metrics[tag] = core.RunMetrics(*data)
+            elif stream == "exit":
+                if tag in self.metrics:
+                    core.recordrun(self.metrics.pop(tag).finish(data))
+                self.logbuffer.end(tag)
+                if data:
+                    self.logbuffer.write("rsync exited with status {}\n"
+                                         .format(data), tag)
+            else:
+                if stream == "stdout":
+                    self.progress[tag].feed(data)
+                    if tag in self.metrics:
+                        self.metrics[tag].feed(data)
+                self.logbuffer.write(data, tag, stream)
+        self._flushlog()
+        if self.job.done:
+            self._finished()
+        else:
+            self.after(_POLL_INTERVAL, self._poll)
+
+    def _log(self, text):
+        self.logbuffer.write(text)
+        self._flushlog()
+
+    def _flushlog(self):
+        # Search results stay up until going back to the live log
+        if self.searching is not None:
+            return
+        lines, overflowed = self.logbuffer.drain()
+        if lines:
+            self._showlog(lines, replace=overflowed)
+
+    def _showlog(self, lines, replace=False):
+        self.log["state"] = (tk.NORMAL,)
+        if replace:
+            self.log.delete("1.0", tk.END)
+        if lines:
+            self.log.insert(tk.END, "\n".join(lines) + "\n")
+        # Bounded, so it doesn't slow down as runs go on
+        excess = int(self.log.index("end-1c").split(".")[0]) - 1 \
+                 - _LOG_WIDGET_LINES
+        if excess > 0:
+            self.log.delete("1.0", "{}.0".format(excess + 1))
+        self.log.see(tk.END)
+        self.log["state"] = (tk.DISABLED,)
+
+    def findlog(self):
+        if self.logbuffer is None:
+            return
+        self.logbuffer.flush()
+        kind = {"Errors": "errors",
+                "Deletions": "deletions"}.get(self.logfilter.get())
+        path, needle = self.logbuffer.path, self.logsearch.get()
+        # One more than shown, to tell whether there are more
+        search = core.Task(lambda: list(islice(core.searchlog(path, needle,
+                                                              kind),
+                                               _SEARCH_LIMIT + 1)))
+        self.searching = search
+        search.start(None)
+        self.after(_SEARCH_INTERVAL, self._searchpoll, search)
+
+    def _searchpoll(self, search):
+        if search is not self.searching:
+            # Superseded, or back to the live log
+            return
+        if not search.done:
+            self.after(_SEARCH_INTERVAL, self._searchpoll, search)
+            return
+        lines = search.result or []
+        if len(lines) > _SEARCH_LIMIT:
+            lines = lines[:_SEARCH_LIMIT] \
+                    + ["(first {} matches shown)".format(_SEARCH_LIMIT)]
+        elif search.error is not None:
+            lines = ["Search failed: {}".format(search.error)]
+        elif not lines:
+            lines = ["(no matches)"]
+        self._showlog(lines, replace=True)
+
+    def livelog(self):
+        if self.logbuffer is None:
+            return
+        self.searching = None
+        self.logbuffer.drain()
+        self._showlog(self.logbuffer.lines, replace=True)
+
+    def _redraw(self):
+        progress = core.ProgressParser.combine(self.progress.values())
+        if progress.updated:
+            for parser in self.progress.values():
+                parser.updated = False
+            self.progressbar["value"] = progress.percent
+            self.throughput.set("{}/s".format(core.human(progress.rate)))
+            self.eta.set("ETA {}".format(core.duration(progress.eta)))
+        self.filerate.set("{:.1f} files/s"
+                          .format(self.meter.update(progress)))
+        if not self.job.done:
+            self.after(_FRAME_INTERVAL, self._redraw)
+
+    def _finished(self):
+        for lease in self.leases:
+            self.sshpool.release(*lease)
+        self.leases = []
+        # Complete the log on disk, for searches
+        self.logbuffer.close()
+        self._showmirrors()
+        if self.job.cancelled:
+            self.status.set("Cancelled.")
+        elif self.job.error is not None:
+            self.status.set("Failed: {}".format(self.job.error))
+        elif self.job.returncode:
+            self.status.set("Failed (rsync exit status {})."
+                            .format(self.job.returncode))
+        else:
+            self.status.set(self.outcome or "Done.")
+            if self.progressbar["mode"] == "determinate":
+                self.progressbar["value"] = 100
+        self.progressbar.stop()
+        self.planbutton["state"] = (tk.NORMAL,)
+        self.syncbutton["state"] = (tk.NORMAL,)
+        self.autotunebutton["state"] = (tk.NORMAL,)
+        self.pausebutton["state"] = (tk.DISABLED,)
+        self.pausebutton["text"] = "Pause"
+        self.cancelbutton["state"] = (tk.DISABLED,)
+        if self.planned is not None:
+            plan, self.planned = self.planned, None
+            messagebox.showinfo(title="Plan", message=plan.summary(),
+                                parent=self)
+
+    def pause(self):
+        if self.job is None or self.job.done:
+            return
+        if self.job.paused:
+            self.job.resume()
+            self.pausebutton["text"] = "Pause"
+            self.status.set("Syncing…")
+        else:
+            self.job.pause()
+            self.pausebutton["text"] = "Resume"
+            self.status.set("Paused.")
+
+    def cancel(self):
+        if self.job is not None and not self.job.done:
+            self.job.cancel()
+            self.status.set("Cancelling…")
 
 if __name__ == "__main__":
     root = tk.Tk()